@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+#
+# Fake chdkptp.sh, 'remoteshoot <file>' stores a synthetic frame as <file>.jpg. The frame
+# shows the disc in the drive tray which is open or the markers when all trays are closed.
+# Commands are taken from -e options or from stdin with -i.
+#
+
+import os
+import shutil
+import sys
+import time
+
+state = os.environ['FREDSIM_STATE']
+
+def frame():
+    with open(os.path.join(state, 'drives'), 'r') as f:
+        drives = f.read().split()
+
+    for n in range(len(drives)):
+        try:
+            with open(os.path.join(state, 'tray-{}'.format(n)), 'r') as f:
+                if f.read() == 'open':
+                    return os.path.join(state, 'images', 'open-{}.jpg'.format(n))
+        except OSError:
+            pass
+
+    return os.path.join(state, 'images', 'calibration.jpg')
+
+def run(cmd):
+    if cmd.startswith('remoteshoot '):
+        time.sleep(float(os.environ.get('FREDSIM_SHOT_TIME', '1')))
+        shutil.copyfile(frame(), cmd.split(' ', 1)[1] + '.jpg')
+    elif cmd.startswith('!print('):
+        print(cmd[len('!print('):].split(')', 1)[0].strip('\'"'))
+    elif cmd in ('quit', 'q'):
+        sys.exit(0)
+    sys.stdout.flush()
+
+# Connecting to the camera and switching it to the recording mode
+time.sleep(float(os.environ.get('FREDSIM_CONNECT_TIME', '3')))
+
+for arg in sys.argv[1:]:
+    if arg.startswith('-e') and arg != '-erec':
+        run(arg[2:])
+
+if '-i' in sys.argv:
+    for line in sys.stdin:
+        run(line.strip())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+#
+# Fake plastic-archiver.sh, takes FREDSIM_READ_TIME seconds (with FREDSIM_READ_JITTER
+# relative deviation) to image a disc and fails with FREDSIM_FAIL_RATE probability
+#
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-o", dest="basedir", default=".")
+parser.add_argument("-i", dest="capture_id")
+parser.add_argument("-a", dest="algorithms", action="append")
+parser.add_argument("-z", dest="compress", action="store_true")
+parser.add_argument("device")
+args = parser.parse_args()
+
+def catalog_set(*fields):
+    subprocess.call([ 'catalog.py', '-s', os.path.realpath(args.basedir), 'set', args.capture_id ] + list(fields))
+
+def log(level, msg):
+    print("{} {} id='{}' dev='{}' {}".format(time.strftime("%Y-%m-%dT%H:%M:%S%z"), level, args.capture_id, args.device, msg), flush=True)
+
+capture_dir = os.path.join(args.basedir, args.capture_id)
+os.makedirs(os.path.join(capture_dir, 'contents'), exist_ok=True)
+os.makedirs(os.path.join(capture_dir, 'reader'), exist_ok=True)
+
+with open(os.path.join(capture_dir, 'metadata-v1.json'), 'w') as f:
+    f.write('{ "version": 1, "image": null }\n')
+with open(os.path.join(capture_dir, 'disk-type.txt'), 'w') as f:
+    f.write("type-1-data\n")
+catalog_set('disk_type=type-1-data')
+
+log("INFO", "Storing info to '{}'".format(capture_dir))
+
+read_time = float(os.environ.get('FREDSIM_READ_TIME', '20'))
+jitter = float(os.environ.get('FREDSIM_READ_JITTER', '0.2'))
+duration = max(random.gauss(read_time, read_time * jitter), 0)
+
+# The TOC is read in the first few percent of the time
+start = time.time()
+time.sleep(duration * 0.05)
+toc_end = time.time()
+time.sleep(duration * 0.95)
+
+with open(os.path.join(capture_dir, 'archiver-timings.txt'), 'a') as f:
+    f.write("toc_read {} {}\n".format(start, toc_end))
+    f.write("data_read {} {}\n".format(toc_end, time.time()))
+
+if random.random() < float(os.environ.get('FREDSIM_FAIL_RATE', '0')):
+    log("ERROR", "Simulated read failure")
+    sys.exit(1)
+
+data = os.urandom(2352 * 16)
+with open(os.path.join(capture_dir, 'contents', 'data.bin'), 'wb') as f:
+    f.write(data)
+digests = dict( (algorithm, hashlib.new(algorithm, data).hexdigest()) for algorithm in (args.algorithms or [ 'sha256' ]) if algorithm in hashlib.algorithms_available )
+with open(os.path.join(capture_dir, 'metadata-v1.json'), 'w') as f:
+    json.dump({ 'version': 1, 'image': { 'file': 'contents/data.bin', 'size': len(data), 'compression': None, 'digests': digests } }, f, indent=1)
+catalog_set('size={}'.format(len(data)), *[ 'checksum.{}={}'.format(name, value) for (name, value) in sorted(digests.items()) ])
+with open(os.path.join(capture_dir, 'contents', 'toc.txt'), 'w') as f:
+    f.write("CD_ROM\n\nTRACK MODE1\nDATAFILE \"data.bin\" 00:00:16\n")
+
+log("INFO", "Disc imaged")
@@ -0,0 +1,4 @@
+#!/bin/sh
+
+# Fake debugcam recorder
+exec sleep infinity
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import fcntl
+import logging
+import math
+import os
+import re
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+
+#
+# A fake UArm Swift firmware speaking the '#<id> <cmd>' protocol on a pseudo terminal.
+#
+# The arm moves through a simple world made of trays with stacks of discs in them. The
+# moves are queued and executed in real time at the F speed (capped at 'max_speed'), the
+# limit switch is pressed when the suction cup touches the top of the stack below it.
+# Switching the pump on in contact with a disc picks it up, switching it off drops the
+# disc onto the stack below the arm.
+#
+# Like the real board, which resets when the serial port is opened, the firmware sends
+# the READY token '@1' each time the port is opened. Opening the port flushes its input
+# buffer, which is seen on the master side of the pty in packet mode.
+#
+# With 'zero_move_reports' off the end of a move to where the arm already is is not
+# reported, like some of the real firmware versions do.
+#
+
+TIOCPKT_FLUSHREAD = 1
+TIOCPKT_FLUSHWRITE = 2
+
+def dist(a,b):
+    return math.sqrt( (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2 )
+
+class Tray:
+    def __init__(self, name, pos, floor_z, count=0):
+        self.name = name
+        self.pos = tuple(pos)
+        self.floor_z = floor_z
+        self.count = count
+
+    def top(self, disc_thickness):
+        return self.floor_z + self.count * disc_thickness
+
+class World:
+    def __init__(self, trays, disc_thickness=1.2, tray_radius=40):
+        self.trays = trays
+        self.disc_thickness = disc_thickness
+        self.tray_radius = tray_radius
+        self.dropped = 0
+
+    def tray_at(self, p):
+        for tray in self.trays:
+            if math.hypot(p[0] - tray.pos[0], p[1] - tray.pos[1]) <= self.tray_radius:
+                return tray
+        return None
+
+    def counts(self):
+        return dict( (tray.name, tray.count) for tray in self.trays )
+
+class Firmware:
+    def __init__(self, world, max_speed=200, speed_scale=1.0, move_overhead=0.05, boot_time=1.0,
+                 sensor_pin=2, led_pin=3, zero_move_reports=True):
+        self.world = world
+        self.max_speed = max_speed
+        self.speed_scale = speed_scale
+        self.move_overhead = move_overhead
+        self.boot_time = boot_time
+        self.sensor_pin = sensor_pin
+        self.led_pin = led_pin
+        self.zero_move_reports = zero_move_reports
+        self.log = logging.getLogger(__name__)
+
+        self.lock = threading.Condition()
+        self.pos = (0, 150, 100)
+        self.target = self.pos
+        self.moves = []
+        self.moving = False
+        self.pump = False
+        self.holding = None
+        self.led = False
+        self.move_reports = False
+        self.boot_at = None
+
+        (self.master, self.slave) = os.openpty()
+        tty.setraw(self.slave)
+        fcntl.ioctl(self.master, termios.TIOCPKT, struct.pack('i', 1))
+        self.device = os.ttyname(self.slave)
+
+    def start(self):
+        for target in (self.read_commands, self.execute_moves):
+            thread = threading.Thread(target=target, name="fredsim-" + target.__name__)
+            thread.daemon = True
+            thread.start()
+
+    def send(self, line):
+        self.log.debug("> {}".format(line))
+        os.write(self.master, (line + "\n").encode('ascii'))
+
+    def reset(self):
+        with self.lock:
+            self.moves = []
+            self.target = self.pos
+            self.move_reports = False
+            self.boot_at = time.monotonic() + self.boot_time
+
+    def read_commands(self):
+        buf = b''
+        while True:
+            timeout = None
+            if self.boot_at is not None:
+                timeout = max(self.boot_at - time.monotonic(), 0)
+
+            (readable, _, _) = select.select([ self.master ], [], [], timeout)
+
+            if self.boot_at is not None and time.monotonic() >= self.boot_at:
+                self.boot_at = None
+                self.send("@1")
+
+            if not readable:
+                continue
+
+            packet = os.read(self.master, 4096)
+            if packet[0] != 0:
+                if packet[0] & (TIOCPKT_FLUSHREAD | TIOCPKT_FLUSHWRITE):
+                    self.log.debug("Port was opened, resetting")
+                    buf = b''
+                    self.reset()
+                continue
+
+            buf += packet[1:]
+            while b'\n' in buf:
+                (line, buf) = buf.split(b'\n', 1)
+                line = line.decode('ascii', 'replace').strip()
+                if line:
+                    self.log.debug("< {}".format(line))
+                    self.handle(line)
+
+    def handle(self, line):
+        m = re.match(r'#(\d+) (\S+)\s*(.*)', line)
+        if not m:
+            return
+
+        (cmd_id, cmd, rest) = m.groups()
+        params = dict( (p[0], p[1:]) for p in rest.split() )
+
+        resp = self.execute(cmd, params)
+        if resp is None:
+            self.send("${} E20".format(cmd_id))
+        elif resp:
+            self.send("${} OK {}".format(cmd_id, resp))
+        else:
+            self.send("${} OK".format(cmd_id))
+
+    def execute(self, cmd, params):
+        with self.lock:
+            if cmd == 'G0':
+                self.queue_move((float(params['X']), float(params['Y']), float(params['Z'])), float(params.get('F', 0)))
+                return ''
+            elif cmd == 'G204':
+                self.queue_move((self.target[0] + float(params['X']), self.target[1] + float(params['Y']),
+                                 self.target[2] + float(params['Z'])), float(params.get('F', 0)))
+                return ''
+            elif cmd == 'G202':
+                return ''
+            elif cmd == 'M200':
+                return 'V1' if self.moving or self.moves else 'V0'
+            elif cmd == 'M231':
+                self.set_pump(params.get('V') == '1')
+                return ''
+            elif cmd == 'M232':
+                return ''
+            elif cmd == 'M240':
+                if int(params['N']) == self.led_pin:
+                    self.led = params.get('V') == '1'
+                return ''
+            elif cmd == 'M2122':
+                self.move_reports = params.get('V') == '1'
+                return ''
+            elif cmd == 'P220':
+                return 'X{:.2f} Y{:.2f} Z{:.2f}'.format(*self.pos)
+            elif cmd == 'P233':
+                return 'V0' if self.in_contact() else 'V1'
+            elif cmd == 'P241':
+                return 'V{}'.format(self.analog(int(params['N'])))
+            elif cmd in ('P201', 'P202', 'P203', 'P204', 'P205'):
+                return 'V' + { 'P201': 'fredsim', 'P202': '3.2', 'P203': '4.0', 'P204': '4.0', 'P205': '00000000' }[cmd]
+
+        return None
+
+    def queue_move(self, p, speed):
+        self.moves.append((p, speed))
+        self.target = p
+        self.lock.notify()
+
+    def execute_moves(self):
+        while True:
+            with self.lock:
+                while not self.moves:
+                    self.lock.wait()
+                (p, speed) = self.moves.pop(0)
+                self.moving = True
+                start = self.pos
+
+            v = self.max_speed if speed == 0 else min(speed * self.speed_scale, self.max_speed)
+            duration = dist(start, p) / v + self.move_overhead
+            t0 = time.monotonic()
+
+            while True:
+                f = min((time.monotonic() - t0) / duration, 1.0)
+                with self.lock:
+                    self.pos = tuple(start[i] + (p[i] - start[i]) * f for i in range(3))
+                if f >= 1.0:
+                    break
+                time.sleep(0.01)
+
+            with self.lock:
+                self.moving = False
+                if self.move_reports and (self.zero_move_reports or dist(start, p) > 0.01):
+                    self.send("@9 V1")
+
+    # The suction cup touches the top of the stack (or the disc held touches it)
+    def in_contact(self):
+        tray = self.world.tray_at(self.pos)
+        if tray is None:
+            return False
+
+        top = tray.top(self.world.disc_thickness)
+        if self.holding is not None:
+            top += self.world.disc_thickness
+
+        return self.pos[2] <= top
+
+    def set_pump(self, state):
+        if state and not self.pump:
+            tray = self.world.tray_at(self.pos)
+            if tray is not None and tray.count > 0 and self.in_contact():
+                tray.count -= 1
+                self.holding = tray.name
+                self.log.info("Picked up disc from tray '{}', {} left".format(tray.name, tray.count))
+        elif not state and self.pump and self.holding is not None:
+            tray = self.world.tray_at(self.pos)
+            if tray is not None:
+                tray.count += 1
+                self.log.info("Dropped disc onto tray '{}', {} there".format(tray.name, tray.count))
+            else:
+                self.world.dropped += 1
+                self.log.warn("Dropped disc at {} outside of any tray".format(self.pos))
+            self.holding = None
+
+        self.pump = state
+
+    # The IR sensor in the source tray
+    def analog(self, pin):
+        if pin != self.sensor_pin:
+            return 0
+
+        value = 100
+        src = [ tray for tray in self.world.trays if tray.name == 'src' ]
+        if self.led and src and src[0].count > 0:
+            value += 200
+        return value
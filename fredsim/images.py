@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+#
+# Synthetic camera frames for the fake camera. Each drive has its center and edge markers
+# drawn in a column of the frame. 'calibration.jpg' shows all trays closed, 'open-<n>.jpg'
+# shows a disc lying in the open tray of drive n, covering its center marker.
+#
+
+column_width = 1300
+frame_height = 1300
+marker_px = 140
+disc_r = 300 # [px]
+
+def marker_positions(n):
+    center = (650 + column_width * n, 450)
+    # The cover circle radius is the marker distance corrected by 'mask_r_fix'
+    edge = (center[0], center[1] + disc_r + 230)
+    return (center, edge)
+
+def draw_marker(frame, aruco_dict, marker_id, pos):
+    quiet = marker_px // 4
+    x0 = pos[0] - marker_px // 2
+    y0 = pos[1] - marker_px // 2
+    frame[y0 - quiet:y0 + marker_px + quiet, x0 - quiet:x0 + marker_px + quiet] = 255
+    marker = aruco.drawMarker(aruco_dict, marker_id, marker_px)
+    frame[y0:y0 + marker_px, x0:x0 + marker_px] = marker[:, :, np.newaxis]
+
+def draw_disc(frame, center, n):
+    cv2.circle(frame, center, disc_r, (200, 190, 180), -1)
+    cv2.circle(frame, center, int(disc_r * 0.9), (40, 60, 160 + 30 * (n % 3)), -1)
+    cv2.putText(frame, "FREDSIM {}".format(n), (center[0] - 150, center[1] - 100), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+    cv2.circle(frame, center, int(disc_r * 0.125), (90, 90, 90), -1)
+
+def generate(directory, config, marker_ids):
+    aruco_dict = aruco.Dictionary_get(config.aruco_dict)
+
+    frame = np.full((frame_height, column_width * len(marker_ids), 3), 120, np.uint8)
+    for (n, ids) in enumerate(marker_ids):
+        (center, edge) = marker_positions(n)
+        draw_marker(frame, aruco_dict, ids['disk_center'], center)
+        draw_marker(frame, aruco_dict, ids['disk_edge'], edge)
+
+    cv2.imwrite("{}/calibration.jpg".format(directory), frame)
+
+    for n in range(len(marker_ids)):
+        open_frame = frame.copy()
+        draw_disc(open_frame, marker_positions(n)[0], n)
+        cv2.imwrite("{}/open-{}.jpg".format(directory, n), open_frame)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+#
+# Runs the brain against simulated hardware and reports the throughput in discs per hour.
+#
+# The UArm is replaced by the fake firmware in firmware.py on a pty, the drives, the camera
+# and the systemd tools by the fake commands in bin/ which are put first on the PATH. The
+# config is the role's config template with the paths pointed into the work directory and
+# the simulated drives filled in, see write_config(). Everything else is the real code.
+#
+#   fredsim/run.py --discs 20 --drives 2 --mode pipelined --staging --read-time 60
+#
+# The brain output goes to brain.log in the work directory, the captures to storage/.
+#
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from firmware import Firmware, World, Tray
+import images
+
+sim_dir = os.path.dirname(os.path.realpath(__file__))
+role_dir = os.path.join(os.path.dirname(sim_dir), 'roles', 'ripper')
+files_dir = os.path.join(role_dir, 'files')
+
+log = logging.getLogger(__name__)
+
+# The simulated trays lie this far apart along X for each additional drive
+drive_spacing = 95 # [mm]
+staging_tray_pos = (-180, 60, 100)
+drop_tray_floor_z = 20
+
+def write_config(workdir, base, args, fw, drives):
+    overrides = {
+        'arm_device': fw.device,
+        'storage_path': os.path.join(workdir, 'storage'),
+        'display_dir': os.path.join(workdir, 'run'),
+        'calibration_filename': os.path.join(workdir, 'run', 'calibration_data.json'),
+        'camera_spool_dir': os.path.join(workdir, 'run'),
+        'arm_socket_path': os.path.join(workdir, 'run', 'arm.sock'),
+        'stack_model_filename': os.path.join(workdir, 'lib', 'stacks.json'),
+        'arm_device_cache_filename': os.path.join(workdir, 'lib', 'arm-device'),
+        'camera_session': args.camera_session,
+        'scheduler_mode': args.mode,
+        'drives': drives,
+        'staging_tray_pos': staging_tray_pos if args.staging else None,
+    }
+
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        f.write("# Generated by fredsim\n\nfrom config_base import *\n\n")
+        for (name, value) in sorted(overrides.items()):
+            f.write("{} = {!r}\n".format(name, value))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the brain on simulated hardware")
+    parser.add_argument("--discs", type=int, default=10, help="Number of discs in the source tray")
+    parser.add_argument("--drives", type=int, default=1, help="Number of simulated drives")
+    parser.add_argument("--mode", choices=['sequential', 'pipelined'], default='pipelined', help="Scheduler mode")
+    parser.add_argument("--staging", action='store_true', help="Use a staging tray")
+    parser.add_argument("--camera-session", dest='camera_session', action='store_true', help="Use a persistent camera session")
+    parser.add_argument("--read-time", dest='read_time', type=float, default=20, help="Mean disc imaging time [s]")
+    parser.add_argument("--read-jitter", dest='read_jitter', type=float, default=0.2, help="Relative deviation of the imaging time")
+    parser.add_argument("--fail-rate", dest='fail_rate', type=float, default=0, help="Probability of an imaging failure")
+    parser.add_argument("--tray-time", dest='tray_time', type=float, default=1.5, help="Time to open or close a tray [s]")
+    parser.add_argument("--shot-time", dest='shot_time', type=float, default=1, help="Time to take a photo [s]")
+    parser.add_argument("--connect-time", dest='connect_time', type=float, default=3, help="Time to connect to the camera [s]")
+    parser.add_argument("--timeout", type=float, default=3600, help="Stop the simulation after this many seconds")
+    parser.add_argument("--workdir", help="Work directory, a temporary one by default")
+    parser.add_argument("-v", "--verbose", action='store_true')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    workdir = os.path.realpath(args.workdir or tempfile.mkdtemp(prefix='fredsim-'))
+    state_dir = os.path.join(workdir, 'state')
+    for d in ('storage', 'run', 'lib', 'state', 'state/images'):
+        os.makedirs(os.path.join(workdir, d), exist_ok=True)
+
+    shutil.copyfile(os.path.join(role_dir, 'templates', 'config.py.j2'), os.path.join(workdir, 'config_base.py'))
+    sys.path.insert(0, workdir)
+    import config_base as base
+
+    # The first drive uses the default markers, the others get a pair of their own
+    devices = [ '/dev/fredsim-cd{}'.format(n) for n in range(args.drives) ]
+    drives = []
+    marker_ids = []
+    for (n, device) in enumerate(devices):
+        tray_pos = (base.drive_tray_pos[0] + drive_spacing * n, base.drive_tray_pos[1], base.drive_tray_pos[2])
+        ids = { 'disk_center': base.center_marker_id, 'disk_edge': base.edge_marker_id }
+        if n > 0:
+            ids = { 'disk_center': 10 + 2 * n, 'disk_edge': 11 + 2 * n }
+        drives.append({ 'device': device, 'tray_pos': tray_pos, 'center_marker_id': ids['disk_center'], 'edge_marker_id': ids['disk_edge'] })
+        marker_ids.append(ids)
+
+    with open(os.path.join(state_dir, 'drives'), 'w') as f:
+        f.write("\n".join(devices) + "\n")
+
+    images.generate(os.path.join(state_dir, 'images'), base, marker_ids)
+
+    trays = [
+        Tray('src', base.src_tray_pos, base.src_tray_z_min + 3, args.discs),
+        Tray('done', base.done_tray_pos, drop_tray_floor_z),
+        Tray('error', base.error_tray_pos, drop_tray_floor_z),
+    ]
+    for (n, drive) in enumerate(drives):
+        trays.append(Tray('drive{}'.format(n), drive['tray_pos'], base.drive_tray_z_min + 3))
+    if args.staging:
+        trays.append(Tray('staging', staging_tray_pos, drop_tray_floor_z))
+
+    world = World(trays, base.disc_thickness)
+    fw = Firmware(world, max_speed=base.move_max_speed, speed_scale=base.move_speed_scale,
+                  sensor_pin=base.sensor_voltage_pin, led_pin=base.led_drive_pin)
+    fw.start()
+
+    write_config(workdir, base, args, fw, drives)
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': os.pathsep.join([ os.path.join(sim_dir, 'bin'), files_dir, os.environ.get('PATH', '') ]),
+        'PYTHONPATH': os.pathsep.join([ workdir, files_dir ]),
+        'FREDSIM_STATE': state_dir,
+        'FREDSIM_READ_TIME': str(args.read_time),
+        'FREDSIM_READ_JITTER': str(args.read_jitter),
+        'FREDSIM_FAIL_RATE': str(args.fail_rate),
+        'FREDSIM_TRAY_TIME': str(args.tray_time),
+        'FREDSIM_SHOT_TIME': str(args.shot_time),
+        'FREDSIM_CONNECT_TIME': str(args.connect_time),
+    })
+
+    log.info("Simulating {} disc(s) with {} drive(s) in '{}', arm on '{}'".format(args.discs, args.drives, workdir, fw.device))
+
+    with open(os.path.join(workdir, 'brain.log'), 'w') as brain_log:
+        brain = subprocess.Popen([ sys.executable, os.path.join(files_dir, 'brain.py') ], cwd=workdir, env=env,
+                                 stdout=brain_log, stderr=subprocess.STDOUT, start_new_session=True)
+
+        start = time.monotonic()
+        first_pickup = None
+        last_drop = None
+        counts = world.counts()
+
+        try:
+            while time.monotonic() - start < args.timeout:
+                time.sleep(1)
+
+                current = world.counts()
+                if current != counts:
+                    log.info("Trays: {}".format(" ".join("{}={}".format(k, v) for (k, v) in sorted(current.items()))))
+                    if first_pickup is None and current['src'] < args.discs:
+                        first_pickup = time.monotonic()
+                    if current['done'] + current['error'] != counts['done'] + counts['error']:
+                        last_drop = time.monotonic()
+                    counts = current
+
+                if counts['done'] + counts['error'] + world.dropped >= args.discs:
+                    break
+
+                if brain.poll() is not None:
+                    log.error("The brain exited with status {}".format(brain.returncode))
+                    break
+            else:
+                log.warn("Simulation timed out after {} seconds".format(args.timeout))
+        finally:
+            if brain.poll() is None:
+                os.killpg(brain.pid, signal.SIGTERM)
+                brain.wait()
+
+    finished = counts['done'] + counts['error']
+    report = {
+        'discs': args.discs,
+        'drives': args.drives,
+        'mode': args.mode,
+        'staging': args.staging,
+        'done': counts['done'],
+        'error': counts['error'],
+        'dropped': world.dropped,
+        'total_time': time.monotonic() - start,
+        'processing_time': (last_drop - first_pickup) if first_pickup and last_drop else None,
+    }
+    report['discs_per_hour'] = finished * 3600 / report['processing_time'] if report['processing_time'] else None
+
+    with open(os.path.join(workdir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(json.dumps(report, indent=1))
+
+if __name__ == "__main__":
+    main()
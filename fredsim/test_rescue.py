@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+#
+# Checks the rescue imaging engine with the image digests computed while it reads, the
+# same way the drive runs them, against a simulated disc:
+#
+#   python3 -m unittest discover fredsim
+#
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'roles', 'ripper', 'files'))
+
+from digest import ImageDigest, poll_interval
+from mmc import MMCError, lead_out_track
+from rescue import RescueReader, data_sector_size
+
+config = types.SimpleNamespace(imaging_chunk_sectors=16, imaging_max_skip_sectors=64, imaging_retry_speed=1000, imaging_retries=2)
+
+class Disc:
+    def __init__(self, sectors, failures):
+        self.sectors = sectors
+        # The LBAs of the reads which fail once
+        self.failures = set(failures)
+
+    def toc(self):
+        return [ { 'track': 1, 'lba': 0, 'data': True }, { 'track': lead_out_track, 'lba': self.sectors, 'data': True } ]
+
+    def sector(self, lba):
+        return hashlib.sha256(str(lba).encode('ascii')).digest() * (data_sector_size // 32)
+
+    def read_cd(self, lba, count, sector_size=2048, raw=False):
+        if lba in self.failures:
+            self.failures.remove(lba)
+            # Long enough for the digest to look at the image while the failed chunk is still a hole
+            time.sleep(3 * poll_interval)
+            raise MMCError("Simulated read error at {}".format(lba))
+        return b''.join(self.sector(n) for n in range(lba, lba + count))
+
+    def set_speed(self, speed):
+        pass
+
+class RescueDigestTest(unittest.TestCase):
+    def image(self, disc):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'data.bin')
+
+        digest = ImageDigest(filename)
+        digest.start()
+        try:
+            bad_sectors = RescueReader(disc, disc.toc(), config, progress=digest.commit).image(filename, os.path.join(directory, 'data.map'))
+        finally:
+            image = digest.finish()
+
+        with open(filename, 'rb') as f:
+            data = f.read()
+        return (bad_sectors, image, data)
+
+    def test_clean_disc(self):
+        disc = Disc(100, [])
+        (bad_sectors, image, data) = self.image(disc)
+
+        self.assertEqual(bad_sectors, 0)
+        self.assertEqual(data, b''.join(disc.sector(n) for n in range(100)))
+        self.assertEqual(image['digests']['sha256'], hashlib.sha256(data).hexdigest())
+
+    def test_first_chunk_fails(self):
+        disc = Disc(100, [ 0 ])
+        (bad_sectors, image, data) = self.image(disc)
+
+        self.assertEqual(bad_sectors, 0)
+        self.assertEqual(data, b''.join(disc.sector(n) for n in range(100)))
+        self.assertEqual(image['size'], len(data))
+        self.assertEqual(image['digests']['sha256'], hashlib.sha256(data).hexdigest())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+#
+# Checks the move end tracking of the UArm against the fake firmware:
+#
+#   python3 -m unittest discover fredsim
+#
+
+import os
+import sys
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'roles', 'ripper', 'files'))
+
+from firmware import Firmware, World
+from uarm import UArm
+
+config = types.SimpleNamespace(serial_port_timeout=5, uarm_async_commands=True, max_inflight_cmds=5,
+                               move_speed_scale=1.0, move_max_speed=200, move_settle_time=0.1,
+                               move_wait_fast_window=0.3, move_wait_fast_delay=0.02,
+                               uarm_move_end_report_cmd='M2122 V1', uarm_move_end_event='@9')
+
+class Port:
+    def __init__(self, device):
+        self.f = open(device, 'r+b', buffering=0)
+
+    def write(self, data):
+        self.f.write(data)
+
+    def readline(self):
+        return self.f.readline()
+
+class MoveEndTest(unittest.TestCase):
+    def arm(self, **kwargs):
+        firmware = Firmware(World([]), **kwargs)
+        firmware.start()
+        arm = UArm(Port(firmware.device), config)
+        arm.setup()
+        self.assertTrue(arm.move_events)
+        return arm
+
+    def test_reported_moves(self):
+        arm = self.arm()
+        arm.wait_for_move_end()
+
+        arm.move_abs((50, 150, 100))
+        arm.wait_for_move_end()
+        self.assertEqual(arm.moves_pending, 0)
+        self.assertTrue(arm.move_done.is_set())
+
+    # The homing moves to where the arm already is, this firmware doesn't report their end
+    def test_missed_move_end(self):
+        arm = self.arm(zero_move_reports=False)
+        arm.wait_for_move_end()
+        self.assertEqual(arm.moves_pending, 0)
+
+        # The next moves end with the event again instead of waiting for the whole predicted window
+        for p in ((50, 150, 100), (50, 200, 100)):
+            arm.move_abs(p)
+            arm.wait_for_move_end()
+            self.assertEqual(arm.moves_pending, 0)
+            self.assertTrue(arm.move_done.is_set())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import socket
+import threading
+from timing import Timings, null_timings
+
+#
+# The brain keeps the UArm connection open for its whole lifetime and shares it with
+# the ripper.py processes through a UNIX socket. This avoids handing over the serial port
+# (and doing the READY handshake, probing and homing) for every disc.
+#
+# The protocol is line based, each request is a JSON object with the UArm method name
+# and its arguments and each response is a JSON object with the result or an error.
+#
+#   > {"method": "move_abs", "args": [[27, 185, 53]]}
+#   < {"result": "$12 OK", "spans": []}
+#
+# The spans the arm timed while handling the request (the waits for the moves to end)
+# come back with the response and go into the timings of the client.
+#
+
+# The UArm methods which can be called through the link
+exported_methods = [
+    'exec_cmd', 'exec_cmds', 'origin', 'robot_moving', 'wait_for_move_end', 'servo_abs', 'move_abs', 'move_rel',
+    'analogread', 'digitalout', 'pos', 'pump', 'grip', 'switch_state', 'pickup_object', 'contact_z', 'disc_present'
+]
+
+class ArmServer:
+    def __init__(self, arm, path):
+        self.arm = arm
+        self.path = path
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+
+        thread = threading.Thread(target=self.serve, name="armlink")
+        thread.daemon = True
+        thread.start()
+
+        self.log.info("Serving arm on socket '{}'".format(self.path))
+
+    def serve(self):
+        while True:
+            (conn, addr) = self.sock.accept()
+            self.log.debug("Arm client connected")
+            try:
+                with conn, conn.makefile('rw') as f:
+                    for line in f:
+                        f.write(json.dumps(self.handle(line)) + "\n")
+                        f.flush()
+            except OSError as e:
+                self.log.warn("Arm client connection failed: {}".format(e))
+            self.log.debug("Arm client disconnected")
+
+    def handle(self, line):
+        try:
+            request = json.loads(line)
+            method = request['method']
+            if method not in exported_methods:
+                return { 'error': "Method '{}' is not exported".format(method) }
+
+            with self.lock:
+                (timings, self.arm.timings) = (self.arm.timings, Timings())
+                try:
+                    result = getattr(self.arm, method)(*request.get('args', []))
+                    return { 'result': result, 'spans': self.arm.timings.spans }
+                finally:
+                    self.arm.timings = timings
+        except Exception as e:
+            self.log.error("Arm request '{}' failed: {}".format(line.rstrip(), e))
+            return { 'error': str(e) }
+
+class ArmClient:
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger(__name__)
+        self.timings = null_timings
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.f = self.sock.makefile('rw')
+
+    def call(self, method, *args):
+        self.f.write(json.dumps({ 'method': method, 'args': args }) + "\n")
+        self.f.flush()
+
+        line = self.f.readline()
+        if not line:
+            raise RuntimeError("Arm server on '{}' closed the connection".format(self.path))
+
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError("Arm request '{}' failed: {}".format(method, response['error']))
+
+        self.timings.merge(response.get('spans', []))
+        return response['result']
+
+    def __getattr__(self, name):
+        if name not in exported_methods:
+            raise AttributeError(name)
+
+        return lambda *args: self.call(name, *args)
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
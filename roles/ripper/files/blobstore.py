@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from digest import metadata_filename, note_compressed_image
+from mmc import MMCDevice, MMCError
+from rescue import RescueReader
+
+#
+# The content-addressed store of disc images on the storage volume. Each distinct image
+# is kept once, named by its SHA-256 digest:
+#
+#   blobs/<first 2 hex digits>/<sha256>[.zst]
+#
+# and the capture directories reference it from contents/ instead of holding a copy,
+# with a hard link or, on file systems without hard links, a symbolic link. The index
+# also keys the images by the hash of the disc's raw TOC (toc.hex), which is known long
+# before the image is, so that a disc which was already archived can be recognized early.
+#
+
+blobs_dir = 'blobs'
+index_filename = 'index.sqlite'
+
+# The fingerprint of a disc, the SHA-256 of the 11 byte full TOC descriptors in toc.hex.
+# Only the descriptors are hashed so that the files written by readom and by the native
+# imaging engines give the same fingerprint.
+def toc_fingerprint(capture_dir):
+    try:
+        with open(os.path.join(capture_dir, 'toc.hex'), 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    descriptors = bytearray()
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 11 and all(len(token) == 2 for token in tokens):
+            try:
+                descriptors += bytes.fromhex("".join(tokens))
+            except ValueError:
+                continue
+
+    # An empty TOC can not tell the discs apart
+    if not descriptors:
+        return None
+    return hashlib.sha256(descriptors).hexdigest()
+
+def load_metadata(capture_dir):
+    with open(os.path.join(capture_dir, metadata_filename), 'r') as f:
+        return json.load(f)
+
+def save_metadata(capture_dir, metadata):
+    tmp_filename = os.path.join(capture_dir, metadata_filename + '.tmp')
+    with open(tmp_filename, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.rename(tmp_filename, os.path.join(capture_dir, metadata_filename))
+
+class BlobStore:
+    def __init__(self, storage_path):
+        self.path = os.path.join(storage_path, blobs_dir)
+        self.log = logging.getLogger(__name__)
+
+        os.makedirs(self.path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, index_filename), timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, toc_hash TEXT, size INTEGER, "
+                            "compression TEXT, capture_id TEXT, created REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS blobs_toc_hash ON blobs (toc_hash)")
+
+    def close(self):
+        self.db.close()
+
+    def blob_path(self, digest, compression=None):
+        return os.path.join(self.path, digest[:2], digest + ('.zst' if compression == 'zstd' else ''))
+
+    # The images of the discs with this TOC fingerprint, the oldest first
+    def find_toc(self, toc_hash):
+        cursor = self.db.execute("SELECT digest, size, compression, capture_id FROM blobs WHERE toc_hash = ? ORDER BY created", (toc_hash,))
+        return [ dict(zip([ 'digest', 'size', 'compression', 'capture_id' ], row)) for row in cursor ]
+
+    # Replace the file at 'filename' with a link to the blob
+    def link(self, blob, filename):
+        tmp_filename = filename + '.link'
+        try:
+            os.link(blob, tmp_filename)
+        except OSError:
+            os.symlink(os.path.relpath(blob, os.path.dirname(filename)), tmp_filename)
+        os.rename(tmp_filename, filename)
+
+    #
+    # Move the image of the capture into the store, or drop it if the store already has
+    # the same image, and reference the blob from the capture directory. The image
+    # metadata in metadata-v1.json gets the path of the blob.
+    #
+    def add(self, capture_dir, capture_id):
+        metadata = load_metadata(capture_dir)
+        image = metadata['image']
+        if image is not None and 'blob' in image:
+            return os.path.join(capture_dir, image['blob'])
+        if image is None or 'sha256' not in image['digests']:
+            self.log.warn("Capture '{}' has no image SHA-256 digest, not storing it".format(capture_id))
+            return None
+
+        image_file = os.path.join(capture_dir, image['file'])
+        digest = image['digests']['sha256']
+        blob = self.blob_path(digest, image['compression'])
+
+        row = self.db.execute("SELECT capture_id, compression FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is not None and os.path.exists(self.blob_path(digest, row[1])):
+            self.log.info("Image of capture '{}' is the same as the one of capture '{}', keeping a reference".format(capture_id, row[0]))
+
+            # The image may have been stored with another compression, the capture
+            # then references it as it is stored
+            blob = self.blob_path(digest, row[1])
+            if row[1] != image['compression']:
+                os.unlink(image_file)
+                image_file = os.path.join(os.path.dirname(image_file), 'data.bin' + ('.zst' if row[1] == 'zstd' else ''))
+                image['file'] = os.path.relpath(image_file, capture_dir)
+                image['compression'] = row[1]
+                image.pop('compressed_size', None)
+                if row[1] is not None:
+                    image['compressed_size'] = os.stat(blob).st_size
+                note_compressed_image(os.path.join(os.path.dirname(image_file), 'toc.txt'), image_file if row[1] is not None else None)
+
+            self.link(blob, image_file)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                # The image file of the capture becomes the blob
+                os.link(image_file, blob)
+            except OSError:
+                os.rename(image_file, blob)
+                os.symlink(os.path.relpath(blob, os.path.dirname(image_file)), image_file)
+
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO blobs (digest, toc_hash, size, compression, capture_id, created) VALUES (?, ?, ?, ?, ?, ?)",
+                                (digest, toc_fingerprint(capture_dir), image['size'], image['compression'], capture_id, time.time()))
+
+        image['blob'] = os.path.relpath(blob, capture_dir)
+        save_metadata(capture_dir, metadata)
+        return blob
+
+    #
+    # Find the image of a disc archived before among the ones with the same TOC fingerprint.
+    # A matching TOC is not a proof of the same contents (a different pressing of the disc can
+    # have the same layout), so sectors sampled over the whole disc are read and compared with
+    # the image. Only the uncompressed images can be compared.
+    #
+    def match(self, capture_dir, dev, toc, samples, log=None):
+        log = log or self.log
+
+        toc_hash = toc_fingerprint(capture_dir)
+        if toc_hash is None:
+            return None
+
+        for entry in self.find_toc(toc_hash):
+            blob = self.blob_path(entry['digest'], entry['compression'])
+            if entry['compression'] is not None or not os.path.exists(blob):
+                continue
+
+            log.info("Disc has the TOC of the one in capture '{}', verifying {} sampled sectors".format(entry['capture_id'], samples))
+            if self.verify(dev, toc, blob, entry['size'], samples, log):
+                return entry
+
+        return None
+
+    def verify(self, dev, toc, blob, size, samples, log):
+        reader = RescueReader(dev, toc, None, log)
+        if reader.size != size:
+            return False
+
+        sectors = [ (track, lba) for track in reader.tracks for lba in (track.start, track.start + track.count - 1) ]
+        total = sum(track.count for track in reader.tracks)
+        for n in range(samples):
+            index = n * total // samples
+            for track in reader.tracks:
+                if index < track.count:
+                    sectors.append((track, track.start + index))
+                    break
+                index -= track.count
+
+        with open(blob, 'rb') as f:
+            for (track, lba) in sectors:
+                try:
+                    data = reader.read(track, lba, 1)
+                except MMCError as e:
+                    log.info("Could not read sampled sector {}: {}".format(lba, e))
+                    return False
+
+                f.seek(track.position(lba))
+                if f.read(track.sector_size) != data:
+                    log.info("Sampled sector {} differs from the archived image".format(lba))
+                    return False
+
+        return True
+
+    # Reference the image of a disc archived before from the capture instead of imaging it
+    def reference(self, capture_dir, capture_id, entry):
+        blob = self.blob_path(entry['digest'], entry['compression'])
+
+        image = { 'size': entry['size'], 'compression': entry['compression'], 'digests': { 'sha256': entry['digest'] } }
+        try:
+            previous = load_metadata(os.path.join(os.path.dirname(self.path), entry['capture_id']))['image']
+            image['digests'] = previous['digests']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        contents_dir = os.path.join(capture_dir, 'contents')
+        os.makedirs(contents_dir, exist_ok=True)
+        image_file = os.path.join(contents_dir, 'data.bin')
+        self.link(blob, image_file)
+
+        # The cdrdao TOC file of the archived image still describes it
+        try:
+            shutil.copyfile(os.path.join(os.path.dirname(self.path), entry['capture_id'], 'contents', 'toc.txt'), os.path.join(contents_dir, 'toc.txt'))
+        except OSError:
+            pass
+
+        image['file'] = os.path.relpath(image_file, capture_dir)
+        image['blob'] = os.path.relpath(blob, capture_dir)
+        image['reference'] = entry['capture_id']
+        save_metadata(capture_dir, { 'version': 1, 'image': image })
+        return image
+
+#
+# Checks from shell scripts whether the disc in the drive was archived before and
+# references the archived image from the capture if it was:
+#
+#   blobstore.py -s /mnt/storage match <capture id> <device> && echo "Already archived"
+#
+def main():
+    parser = argparse.ArgumentParser(description="Look up discs in the blob store")
+    parser.add_argument("-s", "--storage-path", dest="storage_path", default="/mnt/storage", help="Storage root path")
+    parser.add_argument("-n", "--samples", type=int, default=16, help="Number of sectors compared with the archived image")
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    match_parser = subparsers.add_parser("match", help="Reference the archived image if the disc in the drive was archived before")
+    match_parser.add_argument("capture_id")
+    match_parser.add_argument("device")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command != 'match':
+        parser.print_help()
+        sys.exit(1)
+
+    capture_dir = os.path.join(args.storage_path, args.capture_id)
+    blobs = BlobStore(args.storage_path)
+    try:
+        with MMCDevice(args.device) as dev:
+            entry = blobs.match(capture_dir, dev, dev.read_toc(), args.samples)
+        if entry is None:
+            sys.exit(1)
+
+        image = blobs.reference(capture_dir, args.capture_id, entry)
+        print(json.dumps(image))
+    except (OSError, MMCError) as e:
+        logging.getLogger(__name__).warn("Could not check the disc in '{}': {}".format(args.device, e))
+        sys.exit(1)
+    finally:
+        blobs.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
 
-import serial
-import serial.tools.list_ports
 import sys
 import time
 import logging
 import os
 import subprocess
 import uuid
-import json
-import tempfile
-from uarm import UArm
-from vision import Vision
-from drive import Drive
+from discovery import find_arm
+from armlink import ArmServer
+from vision import Vision, CoverWorkers
+from drive import discover_drives
 from storage import Storage
 from display import Display
+from pipeline import Pipeline
+from calibration import Calibration
 
 import config
 
@@ -24,29 +23,26 @@ log = logging.getLogger(__name__)
 display = Display(config)
 
 arm_device = None
-serial_port = None
 arm = None
 
 invocation_id = os.getenv("INVOCATION_ID", str(uuid.uuid4()))
 log.info("Starting brain with invocation '{}'".format(invocation_id))
 
+# The cover workers need to be started before the arm threads
+covers = None
+if config.scheduler_mode == 'pipelined' and config.cover_workers > 0:
+    covers = CoverWorkers(config)
+
 display.msg("DETECT ARM")
 log.info("Detecting where the robot arm is connected")
 
 while True:
 
-    for s in serial.tools.list_ports.comports():
-
-        log.debug("Probing for UArm on serial port '{}' ({})".format(s.device, s.hwid))
-
-        serial_port = serial.Serial(port=s.device, baudrate=115200, timeout=config.serial_port_timeout)
-        arm = UArm(serial_port, config)
-        if arm.connect():
-            arm_device = s.device
-            log.info("Detected UArm on device {}".format(s.device))
-            display.msg("ARM OK")
+    (arm, arm_device) = find_arm(config)
 
     if arm is not None:
+        arm.setup()
+        display.msg("ARM OK")
         break
 
     log.info("No UArm detected on any of the serial ports, retrying in {} seconds".format(config.serial_search_delay))
@@ -74,7 +70,27 @@ os.makedirs(invocation_dir)
 
 vision = Vision(config)
 
-drive = Drive("/dev/cdrom", storage_path)
+# Discover drives
+log.info("Discovering optical drives")
+display.msg("DETECT DRIVES")
+
+#
+# The drives connected through USB bridges may take a while to show up, see
+# the comment for the self-check below.
+#
+for attempt in range(config.drive_discovery_max_attempts):
+    drives = discover_drives(config, storage_path)
+    if len(drives) > 0 and len(drives) >= len(config.drives):
+        break
+
+    display.msg("NO DRIVES, RETRY IN {} SECONDS".format(config.selfcheck_drive_action_timeout))
+    time.sleep(config.selfcheck_drive_action_timeout)
+
+while len(drives) == 0:
+    log.warn("No drives detected, please check drives")
+    display.msg("NO DRIVES, RETRY IN {} SECONDS".format(config.selfcheck_drive_action_timeout))
+    time.sleep(config.selfcheck_drive_action_timeout)
+    drives = discover_drives(config, storage_path)
 
 # Self-test
 log.info("Starting drive self-check")
@@ -85,67 +101,49 @@ display.msg("DRIVE SELF-CHECK")
 # that power is on, the drive is connected and it's time to get to work and announce itself on
 # the USB bus.
 #
-while True:
-
-    # Try to open the drive tray
-    if not drive.open_tray():
-        log.warn("Could not open drive tray, please check drive")
-        display.msg("CANNOT OPEN, RETRY IN {} SECONDS".format(config.selfcheck_drive_action_timeout))
-        time.sleep(config.selfcheck_drive_action_timeout)
-        continue
-
-    # Try to close the drive tray
-    if not drive.close_tray():
-        log.warn("Could not close drive tray, please check drive")
-        display.msg("CANNOT CLOSE, RETRY IN {} SECONDS".format(config.selfcheck_drive_action_timeout))
-        time.sleep(config.selfcheck_drive_action_timeout)
-        continue
+for drive in drives:
+    while True:
 
-    log.info("Drive self-check passed")
-    display.msg("DRIVE OK")
-    break
+        # Try to open the drive tray
+        if not drive.open_tray():
+            log.warn("Could not open drive tray '{}', please check drive".format(drive.device))
+            display.msg("CANNOT OPEN, RETRY IN {} SECONDS".format(config.selfcheck_drive_action_timeout))
+            time.sleep(config.selfcheck_drive_action_timeout)
+            continue
+
+        # Try to close the drive tray
+        if not drive.close_tray():
+            log.warn("Could not close drive tray '{}', please check drive".format(drive.device))
+            display.msg("CANNOT CLOSE, RETRY IN {} SECONDS".format(config.selfcheck_drive_action_timeout))
+            time.sleep(config.selfcheck_drive_action_timeout)
+            continue
+
+        log.info("Drive '{}' self-check passed".format(drive.device))
+        display.msg("DRIVE OK")
+        break
 
 # Calibrate camera
-log.info("Starting camera calibration")
-display.msg("CALIBRATE VISION")
+calibration = Calibration(arm, drives, vision, display, config, storage_path, invocation_dir)
+calibration.start()
 
-calibration_markers = None
-while True:
-
-    # Move the arm away so that the camera can make a photo of the markers
-    # Also close the tray so that both markers are unobstructed
-    arm.move_abs(config.src_tray_pos)
-    arm.wait_for_move_end()
-    drive.close_tray()
-
-    log.info("Acquiring calibration image")
-    display.msg("IMAGE ACQUIRE")
-
-    image_filename = vision.image_acquire(filename=tempfile.mktemp(dir=invocation_dir, prefix="calibration-image-"))
-    if not image_filename:
-        log.warn("Could not acquire image for calibration, please check the camera")
-        display.msg("CANNOT ACQUIRE IMAGE, RETRY IN {} SECONDS".format(config.camera_calibration_delay))
-        time.sleep(config.camera_calibration_delay)
-        continue
+display.msg("VISION OK")
 
-    (calibration_markers,frame) = vision.detect_markers(image_filename)
+if config.scheduler_mode == 'pipelined':
+    if config.staging_tray_pos is None and len(drives) == 1:
+        log.warn("No staging tray configured, discs will not be staged while imaging")
 
-    log.debug("Markers detected during calibration: '{}'".format(calibration_markers))
+    log.info("Using pipelined scheduler with {} drive(s)".format(len(drives)))
+    Pipeline(arm, drives, vision, display, config, storage_path, covers, calibration).run()
 
-    if calibration_markers and 'disk_center' in calibration_markers and 'disk_edge' in calibration_markers:
-        if image_filename:
-            os.unlink(image_filename)        # Remove acquired image if calibration was successful
-        break
-    else:
-        log.warn("Both calibration markers need to be detectable, please adjust the camera or lighting conditions")
-        display.msg("NO MARKERS, RETRY IN {} SECONDS".format(config.camera_calibration_delay))
-        time.sleep(config.camera_calibration_delay)
+# The sequential scheduler only uses the first drive
+drive = drives[0]
 
-log.info("Camera calibration was successful, calibration markers detected: {}".format(calibration_markers))
-display.msg("VISION OK")
+# The ripper.py processes need to connect to the camera themselves
+vision.close()
 
-with open(config.calibration_filename, 'w') as f:
-    json.dump(calibration_markers, f)
+# The ripper.py processes use the arm through the brain
+arm_server = ArmServer(arm, config.arm_socket_path)
+arm_server.start()
 
 while True:
 
@@ -156,30 +154,15 @@ while True:
     # Wait for a disc to be detected in the source tray
     #
     while True:
-        # Switch off LED
-        arm.digitalout(config.led_drive_pin, False)
-        led_off = arm.analogread(config.sensor_voltage_pin)
-
-        time.sleep(config.sensor_delay)
-
-        # Switch on LED
-        arm.digitalout(config.led_drive_pin, True)
-        led_on = arm.analogread(config.sensor_voltage_pin)
-
-        signal = led_on - led_off
-
-        log.debug("A{} readout led on D{} off '{}' led on '{}' signal '{}'".format(config.sensor_voltage_pin, config.led_drive_pin,
-                                                                                   led_off, led_on, signal))
-
-        if signal > config.detect_threshold:
-            log.info("Disc detected in source tray (signal value is '{}')".format(signal))
+        if arm.disc_present():
             display.msg("DETECTED DISK")
             break
 
         time.sleep(config.sensor_delay)
 
-    # Close the serial port so that the ripper.py script can open it again
-    serial_port.close()
+    # The arm is parked and the tray closed between the discs
+    calibration.disc_loaded()
+    vision.close()
 
     capture_id = str(uuid.uuid4())
 
@@ -192,7 +175,7 @@ while True:
 
     capture_unit_name = 'ripper@{}.service'.format(capture_id)
     log.info("Starting ripper for capture id '{}'".format(capture_id))
-    subprocess.call(['sudo', 'systemd-run', '--uid', str(os.getuid()), '--unit', capture_unit_name, '--wait', 'ripper.py', '--arm-device', arm_device, '--capture-id', capture_id, '--storage-path', storage_path, '--calibration-markers', config.calibration_filename])
+    subprocess.call(['sudo', 'systemd-run', '--uid', str(os.getuid()), '--unit', capture_unit_name, '--wait', 'ripper.py', '--arm-socket', config.arm_socket_path, '--drive-device', drive.device, '--capture-id', capture_id, '--storage-path', storage_path, '--calibration-markers', config.calibration_filename])
 
     subprocess.call(['sudo', 'systemctl', 'stop', debugcam_unit_name])
 
@@ -200,11 +183,7 @@ while True:
     os.system("journalctl -a --utc -o short-iso _SYSTEMD_UNIT={} > {}/{}/log.txt".format(capture_unit_name, storage_path, capture_id))
     os.system("journalctl -a --utc -o short-iso _SYSTEMD_UNIT={} > {}/{}/debugcam-log.txt".format(debugcam_unit_name, storage_path, capture_id))
 
-    # Reopen the UArm device
-    serial_port = serial.Serial(port=arm_device, baudrate=115200, timeout=config.serial_port_timeout)
-    arm = UArm(serial_port, config)
-    arm.connect()
 
 arm.origin()
-s.close()
+arm.comm.close()
 
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from vision import marker_positions
+
+#
+# The positions of the calibration markers are stored on the storage volume so that they
+# survive reboots. The stored calibration is keyed by the camera and drive setup (the
+# camera id, the drive devices and their marker ids), a different setup gets a full
+# calibration of its own.
+#
+# Instead of detecting the markers in the whole image, the stored calibration is checked
+# by looking for the markers only in small regions around their stored positions. Small
+# drift is followed by updating the stored positions, when any of the markers moved more
+# than 'calibration_drift_threshold' pixels away from where the last full calibration found
+# it (so that slow drift adds up) or could not be found a full calibration is done.
+#
+# The check is done at startup and every 'calibration_check_interval' discs. The markers
+# are only visible with all of the drive trays closed and the arm out of the way.
+#
+class Calibration:
+    def __init__(self, arm, drives, vision, display, config, storage_path, invocation_dir):
+        self.arm = arm
+        self.drives = drives
+        self.vision = vision
+        self.display = display
+        self.config = config
+        self.invocation_dir = invocation_dir
+        self.log = logging.getLogger(__name__)
+
+        setup = {
+            'camera': config.camera_id,
+            'drives': sorted([ drive.device, drive.marker_ids ] for drive in drives)
+        }
+        key = hashlib.sha1(json.dumps(setup, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+        self.setup = setup
+        self.filename = os.path.join(storage_path, 'calibration', '{}.json'.format(key))
+        self.discs = 0
+        # The marker positions found by the last full calibration, the drift is measured from these
+        self.reference = None
+
+    # Returns the stored marker positions and the ones of the last full calibration
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                calibration = json.load(f)
+            return (calibration['markers'], calibration.get('reference', calibration['markers']))
+        except (OSError, ValueError, KeyError):
+            return (None, None)
+
+    def save(self, markers):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump({ 'setup': self.setup, 'time': time.time(), 'markers': markers, 'reference': self.reference }, f)
+        os.rename(tmp_filename, self.filename)
+
+        # The ripper.py processes read the calibration from here
+        with open(self.config.calibration_filename, 'w') as f:
+            json.dump(markers, f)
+
+    def use(self, markers, reference=None):
+        if reference is not None:
+            self.reference = reference
+        for drive in self.drives:
+            drive.calibration_markers = markers[drive.device]
+        self.save(markers)
+
+    # Move the arm away and close the trays so that all markers are unobstructed
+    def prepare(self):
+        self.arm.move_abs(self.config.src_tray_pos)
+        self.arm.wait_for_move_end()
+        for drive in self.drives:
+            drive.close_tray()
+
+    # Calibrate using the stored calibration if it is still valid
+    def start(self):
+        (markers, reference) = self.load()
+        if markers is not None and all(drive.device in markers and drive.device in reference for drive in self.drives):
+            self.log.info("Loaded calibration from '{}', checking for drift".format(self.filename))
+            self.reference = reference
+            for drive in self.drives:
+                drive.calibration_markers = markers[drive.device]
+
+            if self.check():
+                return
+
+        self.calibrate()
+
+    # Called after each disc is loaded, checks the calibration every 'calibration_check_interval' discs
+    def disc_loaded(self):
+        self.discs += 1
+        if self.config.calibration_check_interval and self.discs % self.config.calibration_check_interval == 0:
+            if not self.check():
+                self.calibrate()
+
+    # Look for the markers close to their calibrated positions, returns False if
+    # a full calibration is needed
+    def check(self):
+        self.prepare()
+
+        image = self.vision.image_capture()
+        if not image:
+            self.log.warn("Could not acquire image for calibration check")
+            return False
+
+        markers = dict()
+        for drive in self.drives:
+            found = self.vision.detect_markers_near(image, drive.calibration_markers, drive.marker_ids, self.config.calibration_roi_size)
+
+            for name, expected in self.reference[drive.device].items():
+                if name not in found:
+                    self.log.warn("Marker '{}' of drive '{}' not found close to {}".format(name, drive.device, drive.calibration_markers.get(name)))
+                    return False
+
+                drift = max(abs(found[name][0] - expected[0]), abs(found[name][1] - expected[1]))
+                if drift > self.config.calibration_drift_threshold:
+                    self.log.warn("Marker '{}' of drive '{}' drifted by {:.1f}px from {} to {}".format(name, drive.device, drift, expected, found[name]))
+                    return False
+
+                self.log.debug("Marker '{}' of drive '{}' drifted by {:.1f}px".format(name, drive.device, drift))
+
+            markers[drive.device] = found
+
+        self.use(markers)
+        self.log.info("Calibration check passed, calibration markers: {}".format(markers))
+        return True
+
+    # Detect the markers in the whole image, retries until all markers are found
+    def calibrate(self):
+        self.log.info("Starting camera calibration")
+        self.display.msg("CALIBRATE VISION")
+
+        while True:
+            self.prepare()
+
+            self.log.info("Acquiring calibration image")
+            self.display.msg("IMAGE ACQUIRE")
+
+            image = self.vision.image_capture()
+            if not image:
+                self.log.warn("Could not acquire image for calibration, please check the camera")
+                self.display.msg("CANNOT ACQUIRE IMAGE, RETRY IN {} SECONDS".format(self.config.camera_calibration_delay))
+                time.sleep(self.config.camera_calibration_delay)
+                continue
+
+            markers = dict()
+            for drive in self.drives:
+                (drive_markers,frame) = self.vision.detect_markers(image, drive.marker_ids)
+
+                self.log.debug("Markers detected during calibration of drive '{}': '{}'".format(drive.device, drive_markers))
+
+                if drive_markers and 'disk_center' in drive_markers and 'disk_edge' in drive_markers:
+                    markers[drive.device] = marker_positions(drive_markers)
+
+            if len(markers) == len(self.drives):
+                break
+
+            # Keep the image for inspection if calibration was not successful
+            with open(tempfile.mktemp(dir=self.invocation_dir, prefix="calibration-image-", suffix=".jpg"), 'wb') as f:
+                f.write(image)
+
+            self.log.warn("Both calibration markers need to be detectable for each drive, please adjust the camera or lighting conditions")
+            self.display.msg("NO MARKERS, RETRY IN {} SECONDS".format(self.config.camera_calibration_delay))
+            time.sleep(self.config.camera_calibration_delay)
+
+        self.use(markers, reference=markers)
+        self.log.info("Camera calibration was successful, calibration markers detected: {}".format(markers))
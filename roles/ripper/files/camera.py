@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import subprocess
+
+#
+# A persistent chdkptp session with the camera. The shoot-photo.sh script connects
+# to the camera and switches it to the recording mode for every photo, which takes
+# several seconds. The session does it once and then only sends 'remoteshoot' commands
+# through the chdkptp interactive console.
+#
+# chdkptp can only save the photos to a file, so they are written to a tmpfs spool
+# directory, read into memory and removed right away.
+#
+class ChdkSession:
+    # Printed after each command to find the end of its output
+    sentinel = "FRED-CMD-DONE"
+
+    def __init__(self, config):
+        self.config = config
+        self.log = logging.getLogger(__name__)
+        self.proc = None
+        self.shot_id = 0
+
+    def start(self):
+        self.log.info("Starting chdkptp session")
+        self.proc = subprocess.Popen(self.config.chdkptp_session_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+
+    def close(self):
+        if self.proc is None:
+            return
+
+        self.log.info("Closing chdkptp session")
+        try:
+            self.proc.stdin.write("quit\n")
+            self.proc.stdin.close()
+            self.proc.wait(timeout=self.config.chdkptp_timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def command(self, cmd):
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+
+        self.log.debug("Sending chdkptp command '{}'".format(cmd))
+        self.proc.stdin.write("{}\n!print('{}') io.stdout:flush()\n".format(cmd, self.sentinel))
+        self.proc.stdin.flush()
+
+        output = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                self.log.error("chdkptp session exited while running command '{}'".format(cmd))
+                self.proc.wait()
+                self.proc = None
+                return None
+
+            line = line.rstrip('\n')
+            if line.endswith(self.sentinel):
+                return output
+
+            self.log.debug("chdkptp: {}".format(line))
+            output.append(line)
+
+    # Take a photo and return the JPEG data
+    def shoot(self):
+        self.shot_id += 1
+        filename = os.path.join(self.config.camera_spool_dir, "shot-{}-{}".format(os.getpid(), self.shot_id))
+
+        output = self.command("remoteshoot {}".format(filename))
+
+        # chdkptp adds the .jpg extension
+        filename += ".jpg"
+
+        if output is None or any(line.startswith("ERROR") for line in output) or not os.path.exists(filename):
+            self.log.warn("Could not take photo, chdkptp output was: {}".format(output))
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+            # Start from scratch next time, the camera might have been disconnected
+            self.close()
+            return None
+
+        with open(filename, 'rb') as f:
+            data = f.read()
+        os.unlink(filename)
+
+        return data
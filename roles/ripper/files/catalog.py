@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+#
+# The catalog of all captures on the storage volume. Instead of scraping the capture
+# directories for a summary, the capture steps record what they learn about the capture
+# as they go: ripper.py (or the pipelined scheduler) the status and timings and
+# plastic-archiver.sh the disk type, data size and checksums.
+#
+# The summary uses the format of the summarize-rip.py script, which is what
+# summary-plot.gnuplot expects:
+#
+#   catalog.py -s /mnt/storage summary > summary.dat
+#
+# From shell scripts the fields are set with:
+#
+#   catalog.py -s /mnt/storage set <capture id> disk_type=audio-cd size=123456
+#
+
+# The catalog file name on the storage volume
+catalog_filename = 'catalog.sqlite'
+
+summary_header = "#ID\tstatus\tdisk_type\tsize\tstart\tend\telapsed"
+
+# The columns which can be set, the dictionaries are stored as JSON
+columns = {
+    'status': str,
+    'disk_type': str,
+    'size': int,
+    'start_time': str,
+    'end_time': str,
+    'elapsed': int,
+    'checksums': dict,
+    'timings': dict,
+}
+
+# The timestamp format of 'journalctl -o short-iso --utc' used in the summaries
+def timestamp(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(t))
+
+class Catalog:
+    def __init__(self, storage_path):
+        self.filename = os.path.join(storage_path, catalog_filename)
+        self.log = logging.getLogger(__name__)
+
+        # Several archivers and the brain can update the catalog at the same time
+        self.db = sqlite3.connect(self.filename, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS captures (id TEXT PRIMARY KEY, status TEXT, disk_type TEXT, size INTEGER, "
+                            "start_time TEXT, end_time TEXT, elapsed INTEGER, checksums TEXT, timings TEXT, updated REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS captures_start_time ON captures (start_time)")
+
+    def close(self):
+        self.db.close()
+
+    def get(self, capture_id):
+        cursor = self.db.execute("SELECT status, disk_type, size, start_time, end_time, elapsed, checksums, timings FROM captures WHERE id = ?", (capture_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        entry = dict(zip([ 'status', 'disk_type', 'size', 'start_time', 'end_time', 'elapsed', 'checksums', 'timings' ], row))
+        for name in ('checksums', 'timings'):
+            entry[name] = json.loads(entry[name]) if entry[name] else dict()
+        return entry
+
+    # Set the given fields of the capture, the checksums are added to the ones already stored
+    def update(self, capture_id, **fields):
+        for name in fields:
+            if name not in columns:
+                raise ValueError("Unknown catalog field '{}'".format(name))
+
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO captures (id) VALUES (?)", (capture_id,))
+
+            if 'checksums' in fields:
+                row = self.db.execute("SELECT checksums FROM captures WHERE id = ?", (capture_id,)).fetchone()
+                checksums = json.loads(row[0]) if row[0] else dict()
+                checksums.update(fields['checksums'])
+                fields['checksums'] = checksums
+
+            values = [ json.dumps(value) if columns[name] is dict else value for (name, value) in fields.items() ]
+            assignments = "".join("{} = ?, ".format(name) for name in fields)
+            self.db.execute("UPDATE captures SET {}updated = ? WHERE id = ?".format(assignments), values + [ time.time(), capture_id ])
+
+    # The summary rows in the order the captures were started
+    def summary(self, since=None):
+        query = "SELECT id, status, disk_type, size, start_time, end_time, elapsed FROM captures WHERE start_time IS NOT NULL"
+        params = []
+        if since is not None:
+            query += " AND start_time >= ?"
+            params.append(since)
+
+        for row in self.db.execute(query + " ORDER BY start_time", params):
+            yield "\t".join('' if value is None else str(value) for value in row)
+
+# The summary status of a capture from the tray its disc ended up in
+def capture_status(result):
+    return { 'done': 'done', 'error': 'fail' }.get(result, 'unknown')
+
+# Record the fields of a capture, a failure to do so must not stop the capture
+def record(storage_path, capture_id, **fields):
+    try:
+        catalog = Catalog(storage_path)
+        try:
+            catalog.update(capture_id, **fields)
+        finally:
+            catalog.close()
+    except sqlite3.Error as e:
+        logging.getLogger(__name__).warn("Could not update the catalog entry of capture '{}': {}".format(capture_id, e))
+
+def record_start(storage_path, capture_id, start_time):
+    record(storage_path, capture_id, status='unknown', start_time=timestamp(start_time))
+
+def record_finish(storage_path, capture_id, result, start_time, timings):
+    end_time = time.time()
+    summary = dict( (name, [ total, count ]) for (name, (total, count)) in timings.summary().items() )
+    record(storage_path, capture_id, status=capture_status(result), end_time=timestamp(end_time),
+           elapsed=int(end_time - start_time), timings=summary)
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and update the capture catalog")
+    parser.add_argument("-s", "--storage-path", dest="storage_path", default="/mnt/storage", help="Storage root path")
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    summary_parser = subparsers.add_parser("summary", help="Print the capture summary")
+    summary_parser.add_argument("--since", help="Only the captures started at or after this timestamp")
+
+    show_parser = subparsers.add_parser("show", help="Print the catalog entry of a capture as JSON")
+    show_parser.add_argument("capture_id")
+
+    set_parser = subparsers.add_parser("set", help="Set fields of a capture")
+    set_parser.add_argument("capture_id")
+    set_parser.add_argument("fields", nargs='+', help="Fields as name=value, checksums as checksum.<algorithm>=<digest>")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    catalog = Catalog(args.storage_path)
+
+    if args.command == 'summary':
+        print(summary_header)
+        for line in catalog.summary(args.since):
+            print(line)
+    elif args.command == 'show':
+        print(json.dumps(catalog.get(args.capture_id), indent=1))
+    elif args.command == 'set':
+        fields = dict()
+        for field in args.fields:
+            (name, value) = field.split('=', 1)
+            if name.startswith('checksum.'):
+                fields.setdefault('checksums', dict())[name[len('checksum.'):]] = value
+            elif columns.get(name) in (str, int):
+                fields[name] = columns[name](value)
+            else:
+                parser.error("Field '{}' cannot be set".format(name))
+        catalog.update(args.capture_id, **fields)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    catalog.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+# The BLAKE3 digest and the zstd compression are only available with the modules installed
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#
+# Computes the digests of a disc image, and optionally compresses it, while the image is
+# being written. The data is read back right behind the writer so it still comes from the
+# page cache and the image never has to be read again from the storage.
+#
+# The writer either just appends to the file (cdrdao), then the file is followed as it
+# grows, or it tells how much of the file is final with commit() (the rescue engine,
+# which writes the damaged areas later). When cdrdao starts over with a new file the
+# digests are started over as well.
+#
+# The results go to the capture's metadata-v1.json:
+#
+#   { "version": 1, "image": { "file": "contents/data.bin.zst", "size": 123456,
+#     "compression": "zstd", "digests": { "sha256": "...", "blake3": "..." } } }
+#
+# From shell scripts the image is followed in the background until SIGUSR1 is received:
+#
+#   digest.py -m metadata-v1.json contents/data.bin &
+#   cdrdao read-cd ...
+#   kill -USR1 $!; wait $!
+#
+
+metadata_filename = 'metadata-v1.json'
+
+read_size = 1024 * 1024
+poll_interval = 0.2 # [s]
+
+class ImageDigest:
+    def __init__(self, filename, algorithms=('sha256',), compression=None, compression_level=3):
+        self.filename = filename
+        self.algorithms = algorithms
+        self.compression = compression
+        self.compression_level = compression_level
+        self.log = logging.getLogger(__name__)
+
+        self.committed = None
+        self.finished = False
+        self.error = None
+        self.thread = None
+        self.compressed_file = None
+
+        if 'blake3' in algorithms and blake3 is None:
+            self.log.warn("The blake3 module is not installed, BLAKE3 digest will not be computed")
+            self.algorithms = [ algorithm for algorithm in algorithms if algorithm != 'blake3' ]
+        if compression == 'zstd' and zstandard is None:
+            self.log.warn("The zstandard module is not installed, the image will not be compressed")
+            self.compression = None
+
+        self.compressed_filename = filename + '.zst' if self.compression == 'zstd' else None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.follow, name="digest-{}".format(os.path.basename(self.filename)))
+        self.thread.daemon = True
+        self.thread.start()
+
+    # The image is final up to this many bytes
+    def commit(self, size):
+        self.committed = size
+
+    # The writer is done, returns the image metadata or None if the image could not be processed
+    def finish(self):
+        self.finished = True
+        self.thread.join()
+
+        if self.error is not None:
+            self.log.error("Could not compute the digests of '{}': {}".format(self.filename, self.error))
+            return None
+
+        metadata = {
+            'size': self.size,
+            'compression': self.compression,
+            'digests': dict( (name, hasher.hexdigest()) for (name, hasher) in self.hashers.items() ),
+        }
+
+        # The compressed image replaces the uncompressed one
+        if self.compressed_filename is not None:
+            os.unlink(self.filename)
+            metadata['compressed_size'] = os.stat(self.compressed_filename).st_size
+            note_compressed_image(os.path.join(os.path.dirname(self.filename), 'toc.txt'), self.compressed_filename)
+
+        return metadata
+
+    def reset(self):
+        self.hashers = dict()
+        for name in self.algorithms:
+            self.hashers[name] = blake3.blake3() if name == 'blake3' else hashlib.new(name)
+        self.size = 0
+
+        if self.compressed_filename is not None:
+            if self.compressed_file is not None:
+                self.compressed_file.close()
+            self.compressed_file = open(self.compressed_filename, 'wb')
+            self.compressor = zstandard.ZstdCompressor(level=self.compression_level).compressobj()
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        self.size += len(data)
+
+        if self.compressed_filename is not None:
+            self.compressed_file.write(self.compressor.compress(data))
+
+    def follow(self):
+        f = None
+        try:
+            self.reset()
+            while True:
+                # Wait for the writer to create the file, start over if it creates a new one
+                if f is None or (os.path.exists(self.filename) and os.stat(self.filename).st_ino != os.fstat(f.fileno()).st_ino):
+                    if f is not None:
+                        self.log.info("Image '{}' was written again, starting over".format(self.filename))
+                        f.close()
+                        self.reset()
+                    f = open(self.filename, 'rb') if os.path.exists(self.filename) else None
+
+                finished = self.finished
+                if f is not None:
+                    limit = self.committed if self.committed is not None and not finished else os.fstat(f.fileno()).st_size
+                    while self.size < limit:
+                        data = f.read(min(read_size, limit - self.size))
+                        if not data:
+                            break
+                        self.update(data)
+
+                if finished:
+                    break
+                time.sleep(poll_interval)
+
+            if self.compressed_filename is not None:
+                self.compressed_file.write(self.compressor.flush())
+                self.compressed_file.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            if f is not None:
+                f.close()
+
+compressed_note = "// The image is stored compressed, run 'zstd -d {}' before using this file\n"
+
+# The cdrdao TOC file next to the image still names the uncompressed data file, a
+# comment on top tells that it has to be decompressed before the TOC file is used.
+# Without the compressed file name the comment is removed.
+def note_compressed_image(toc_filename, compressed_filename):
+    try:
+        with open(toc_filename, 'r') as f:
+            lines = f.read().splitlines(True)
+    except OSError:
+        return
+
+    prefix = compressed_note.split('{}')[0]
+    lines = [ line for line in lines if not line.startswith(prefix) ]
+    if compressed_filename is not None:
+        lines.insert(0, compressed_note.format(os.path.basename(compressed_filename)))
+
+    with open(toc_filename + '.tmp', 'w') as f:
+        f.write("".join(lines))
+    os.rename(toc_filename + '.tmp', toc_filename)
+
+# Write the image metadata into the capture directory, the image path is relative to it
+def write_metadata(capture_dir, image_filename, image):
+    metadata = { 'version': 1, 'image': None }
+    if image is not None:
+        metadata['image'] = dict(image)
+        filename = image_filename + '.zst' if image['compression'] == 'zstd' else image_filename
+        metadata['image']['file'] = os.path.relpath(filename, capture_dir)
+
+    tmp_filename = os.path.join(capture_dir, metadata_filename + '.tmp')
+    with open(tmp_filename, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.rename(tmp_filename, os.path.join(capture_dir, metadata_filename))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the digests of a disc image while it is being written")
+    parser.add_argument("-m", "--metadata", required=True, help="The capture metadata file to write")
+    parser.add_argument("-a", "--algorithm", dest="algorithms", action="append", help="Digest algorithm, sha256 by default")
+    parser.add_argument("-z", "--compress", action="store_true", help="Compress the image with zstd")
+    parser.add_argument("image", help="Image file")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    digest = ImageDigest(args.image, args.algorithms or [ 'sha256' ], 'zstd' if args.compress else None)
+
+    done = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: done.set())
+
+    digest.start()
+    while not done.wait(1):
+        pass
+
+    image = digest.finish()
+    write_metadata(os.path.dirname(os.path.abspath(args.metadata)), os.path.abspath(args.image), image)
+    print(json.dumps(image))
+
+if __name__ == "__main__":
+    main()
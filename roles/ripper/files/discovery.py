@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import logging
+import serial
+import serial.tools.list_ports
+from serial.tools.list_ports_common import ListPortInfo
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from uarm import UArm
+
+log = logging.getLogger(__name__)
+
+#
+# Finding the UArm means opening each serial port and waiting for the READY token
+# sent by the firmware after the board resets. This takes a few seconds per port,
+# so the ports are probed concurrently with a short timeout.
+#
+# The port the arm was found on last time and the ports with known UArm USB ids
+# are probed first, the rest of the ports are only touched if the arm is not
+# found on any of those.
+#
+
+def load_cached_port(config):
+    try:
+        with open(config.arm_device_cache_filename, 'r') as f:
+            (device, hwid) = f.read().rstrip('\n').split('\t', 1)
+            return (device, hwid)
+    except (OSError, ValueError):
+        return (None, None)
+
+def store_cached_port(config, port):
+    try:
+        with open(config.arm_device_cache_filename, 'w') as f:
+            f.write("{}\t{}\n".format(port.device, port.hwid))
+    except OSError as e:
+        log.warn("Could not store the UArm port in '{}': {}".format(config.arm_device_cache_filename, e))
+
+def probe_port(port, config):
+    log.debug("Probing for UArm on serial port '{}' ({})".format(port.device, port.hwid))
+
+    try:
+        serial_port = serial.Serial(port=port.device, baudrate=115200, timeout=config.serial_probe_timeout)
+    except serial.SerialException as e:
+        log.debug("Could not open serial port '{}': {}".format(port.device, e))
+        return None
+
+    arm = UArm(serial_port, config)
+    if arm.wait_for_ready():
+        serial_port.timeout = config.serial_port_timeout
+        return arm
+
+    serial_port.close()
+    return None
+
+# Probe the ports concurrently and return the first UArm which signals READY
+def probe_ports(ports, config):
+    if not ports:
+        return (None, None)
+
+    executor = ThreadPoolExecutor(max_workers=len(ports))
+    pending = dict( (executor.submit(probe_port, port, config), port) for port in ports )
+    found = (None, None)
+
+    while pending and found[0] is None:
+        (done, not_done) = wait(pending.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            port = pending.pop(future)
+            arm = future.result()
+            if arm is None:
+                continue
+
+            if found[0] is None:
+                found = (arm, port)
+            else:
+                arm.comm.close()
+
+    # Close the ports of any other probes which would still succeed
+    for future in pending:
+        future.add_done_callback(lambda f: f.result() and f.result().comm.close())
+    executor.shutdown(wait=False)
+
+    return found
+
+# Find the serial port the UArm is connected to, returns a UArm in the READY state and the port device
+def find_arm(config):
+    if config.arm_device is not None:
+        port = ListPortInfo(config.arm_device)
+        arm = probe_port(port, config)
+        if arm is not None:
+            log.info("Detected UArm on device {}".format(port.device))
+        return (arm, port.device if arm is not None else None)
+
+    (cached_device, cached_hwid) = load_cached_port(config)
+
+    preferred = []
+    others = []
+    for port in serial.tools.list_ports.comports():
+        if (port.device == cached_device and port.hwid == cached_hwid) or (port.vid, port.pid) in config.uarm_usb_ids:
+            preferred.append(port)
+        else:
+            others.append(port)
+
+    for ports in (preferred, others):
+        (arm, port) = probe_ports(ports, config)
+        if arm is not None:
+            log.info("Detected UArm on device {}".format(port.device))
+            store_cached_port(config, port)
+            return (arm, port.device)
+
+    return (None, None)
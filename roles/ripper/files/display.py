@@ -6,7 +6,7 @@ import os
 class Display:
     def __init__(self, config):
         self.config = config
-        self.display_dir = "/run/fred"
+        self.display_dir = config.display_dir
 
     def msg(self, msg):
         with open(os.path.join(self.display_dir, 'line1'), "w") as f:
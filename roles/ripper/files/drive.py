@@ -2,42 +2,357 @@
 
 import subprocess
 import logging
+import json
+import os
+import threading
+import time
+import sqlite3
+from timing import Timings, null_timings
+from mmc import MMCDevice, MMCError, full_toc_hex, lead_out_track
+from rescue import RescueReader, write_toc
+from digest import ImageDigest, write_metadata
+from blobstore import BlobStore
+import catalog
 
 class Drive:
-    def __init__(self, device="/dev/cdrom", capture_basedir="."):
+    def __init__(self, device="/dev/cdrom", capture_basedir=".", tray_pos=None, tray_z_min=None, marker_ids=None, config=None):
         self.log = logging.getLogger(__name__)
         self.device = device
         self.capture_basedir = capture_basedir
+        self.config = config
+        self.imaging_engine = config.imaging_engine if config is not None else 'archiver'
+        self.read_proc = None
+        self.read_thread = None
+        self.read_result = None
+        self.read_timings = None
+        self.read_start = None
+        self.read_end = None
+        self.read_capture_id = None
+        self.tray_proc = None
+        self.tray_start = None
+        self.timings = null_timings
+        # Delay for 500 ms between checks if the drive is ready
+        self.ready_poll_delay = 0.5
+
+        # The position of the drive tray in arm XYZ coordinates
+        self.tray_pos = tray_pos
+        self.tray_z_min = tray_z_min
+
+        # The calibration markers placed on this drive, marker name -> ARuCO marker id
+        self.marker_ids = marker_ids
+        # Calibration data for the cover image, filled in during camera calibration
+        self.calibration_markers = None
+
+    # Start opening the tray without waiting for it, open_tray() waits for the result
+    def start_open_tray(self):
+        self.tray_proc = subprocess.Popen(["eject", self.device])
+        self.tray_start = time.time()
 
     def open_tray(self):
         # Open tray
-        returncode = subprocess.call(["eject", self.device])
+        if self.tray_proc is None:
+            self.start_open_tray()
+
+        returncode = self.tray_proc.wait()
+        self.tray_proc = None
+        self.timings.add('tray_open', self.tray_start, time.time() - self.tray_start)
 
         if returncode == 0:
-            self.log.info("Opened drive tray")
+            self.log.info("Opened drive tray '{}'".format(self.device))
             return True
         else:
-            self.log.error("Could not open drive tray")
+            self.log.error("Could not open drive tray '{}'".format(self.device))
             return False
 
     def close_tray(self):
-        # Open tray
-        returncode = subprocess.call(["eject", "-t", self.device])
+        with self.timings.span('tray_close'):
+            returncode = subprocess.call(["eject", "-t", self.device])
 
         if returncode == 0:
-            self.log.info("Closed drive tray")
+            self.log.info("Closed drive tray '{}'".format(self.device))
             return True
         else:
-            self.log.warn("Could not close drive tray")
+            self.log.warn("Could not close drive tray '{}'".format(self.device))
             return False
 
-    def read_disc(self, capture_id):
-        # Make the image
-        returncode = subprocess.call(["plastic-archiver.sh", "-o", self.capture_basedir, "-i", capture_id, self.device])
+    # Start imaging the disc in the background, the caller can do other work
+    # and check read_running() or block in wait_read() to get the result.
+    def start_read(self, capture_id, output=None):
+        if self.imaging_engine in ('native', 'rescue'):
+            self.read_result = None
+            self.read_timings = Timings()
+            self.read_thread = threading.Thread(target=self.image_disc, args=(capture_id, output, self.read_timings),
+                                                name="image-{}".format(capture_id))
+            self.read_thread.start()
+        else:
+            stderr = subprocess.STDOUT if output is not None else None
+            cmd = [ "plastic-archiver.sh", "-o", self.capture_basedir, "-i", capture_id ]
+            if self.config is not None:
+                if self.config.dedup_images:
+                    cmd += [ "-d", str(self.config.dedup_verify_samples) ]
+                for algorithm in self.config.image_digests:
+                    cmd += [ "-a", algorithm ]
+                if self.config.image_compression == 'zstd':
+                    cmd.append("-z")
+            self.read_proc = subprocess.Popen(cmd + [ self.device ], stdout=output, stderr=stderr)
+        self.read_start = time.time()
+        self.read_end = None
+        self.read_capture_id = capture_id
+        self.log.info("Started imaging disk in '{}' for capture id '{}'".format(self.device, capture_id))
+
+    def read_running(self):
+        if self.read_thread is not None:
+            if self.read_thread.is_alive():
+                return True
+        elif self.read_proc is None:
+            return False
+        elif self.read_proc.poll() is None:
+            return True
+
+        if self.read_end is None:
+            self.read_end = time.time()
+        return False
+
+    def wait_read(self):
+        if self.read_thread is not None:
+            self.read_thread.join()
+            self.read_thread = None
+            returncode = 0 if self.read_result else 1
+        else:
+            returncode = self.read_proc.wait()
+            self.read_proc = None
+
+        # The TOC and data read stages are recorded by the imaging engine
+        self.timings.add('read', self.read_start, (self.read_end or time.time()) - self.read_start)
+        if self.imaging_engine == 'archiver':
+            self.timings.load(os.path.join(self.capture_basedir, self.read_capture_id, 'archiver-timings.txt'))
+        else:
+            self.timings.merge(self.read_timings.spans)
 
         if returncode == 0:
             self.log.info("Successfuly imaged disk")
+            if self.config is not None and self.config.dedup_images:
+                self.store_image(self.read_capture_id)
             return True
         else:
             self.log.warn("Could not image disk")
             return False
+
+    # Move the image into the blob store shared by the captures (see blobstore.py)
+    def store_image(self, capture_id):
+        try:
+            with self.timings.span('dedup'):
+                blobs = BlobStore(self.capture_basedir)
+                try:
+                    blobs.add(os.path.join(self.capture_basedir, capture_id), capture_id)
+                finally:
+                    blobs.close()
+        except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+            self.log.warn("Could not put the image of capture '{}' into the blob store: {}".format(capture_id, e))
+
+    def read_disc(self, capture_id):
+        # Make the image
+        self.start_read(capture_id)
+        return self.wait_read()
+
+    #
+    # The native imaging engines, run in the read thread. They do what plastic-archiver.sh
+    # does and write the same capture directory layout, but all of the information about
+    # the drive and the disc is read through one MMC session (see mmc.py) instead of a chain
+    # of tools each opening the device again. The 'native' engine then hands the bulk read
+    # over to cdrdao, the 'rescue' engine reads the sectors itself in the same session (see
+    # rescue.py) retrying only the damaged areas of the disc.
+    #
+    def image_disc(self, capture_id, output, timings):
+        self.read_result = False
+        log = logging.LoggerAdapter(logging.getLogger(__name__), { 'capture_id': capture_id })
+
+        capture_dir = os.path.join(self.capture_basedir, capture_id)
+        os.makedirs(os.path.join(capture_dir, 'reader'), exist_ok=True)
+
+        # The metadata without the image marks that spec v1 is being used
+        write_metadata(capture_dir, None, None)
+
+        log.info("Storing info to '{}'".format(capture_dir))
+
+        dev = MMCDevice(self.device)
+        try:
+            dev.open()
+            self.read_result = self.image_disc_session(dev, capture_id, capture_dir, output, timings, log)
+        except (OSError, MMCError) as e:
+            log.error("Could not image disc in '{}': {}".format(self.device, e))
+        finally:
+            dev.close()
+
+    def image_disc_session(self, dev, capture_id, capture_dir, output, timings, log):
+        with timings.span('toc_read'):
+            reader = dev.inquiry()
+            disk_type = self.wait_disc_ready(dev, log)
+            if disk_type == 'no-disc':
+                log.error("Disk not detected")
+                return False
+
+            toc = dev.read_toc()
+            full_toc = dev.read_full_toc()
+            disk_info = dev.read_disc_information()
+
+        log.debug("Detected disk type is '{}'".format(disk_type))
+
+        with open(os.path.join(capture_dir, 'reader', 'reader.json'), 'w') as f:
+            json.dump(reader, f, indent=1)
+        with open(os.path.join(capture_dir, 'disk-type.txt'), 'w') as f:
+            f.write(disk_type + "\n")
+        with open(os.path.join(capture_dir, 'toc.hex'), 'w') as f:
+            f.write(full_toc_hex(full_toc))
+        with open(os.path.join(capture_dir, 'disk-info.json'), 'w') as f:
+            json.dump({ 'disk_info': disk_info, 'toc': toc }, f, indent=1)
+
+        catalog.record(self.capture_basedir, capture_id, disk_type=disk_type)
+
+        tracks = [ track for track in toc if track['track'] != lead_out_track ]
+        log.info("Disc contains {} session(s), TOC has {} audio tracks + {} data tracks ({} tracks total)".format(
+            disk_info['sessions'], len([ t for t in tracks if not t['data'] ]), len([ t for t in tracks if t['data'] ]), len(tracks)))
+
+        if disk_info['sessions'] > 1:
+            log.error("Multisession disks are not yet supported")
+            return False
+
+        if disk_type not in ('audio-cd', 'type-1-data'):
+            log.error("Unknown disk type '{}'".format(disk_type))
+            return False
+
+        contents_dir = os.path.join(capture_dir, 'contents')
+        os.makedirs(contents_dir, exist_ok=True)
+
+        if self.config.dedup_images:
+            with timings.span('fingerprint'):
+                if self.reference_known_disc(dev, toc, capture_dir, capture_id, log):
+                    return True
+
+        # The image is hashed (and compressed) while it is being read
+        datafile = os.path.join(contents_dir, 'data.bin')
+        digest = ImageDigest(datafile, self.config.image_digests, self.config.image_compression, self.config.image_compression_level)
+        digest.start()
+
+        try:
+            with timings.span('data_read'):
+                if self.imaging_engine == 'rescue':
+                    result = self.rescue_read(dev, toc, contents_dir, log, digest.commit)
+                else:
+                    # cdrdao opens the device itself
+                    dev.close()
+                    result = self.run_cdrdao(contents_dir, output, log)
+        finally:
+            with timings.span('digest'):
+                image = digest.finish()
+            write_metadata(capture_dir, datafile, image)
+
+        if image is not None:
+            catalog.record(self.capture_basedir, capture_id, size=image['size'], checksums=image['digests'])
+
+        return result
+
+    # The drive reports not being ready while it spins up the disc after the tray was
+    # closed, returns the disc type once it is ready or after 'imaging_ready_timeout'
+    def wait_disc_ready(self, dev, log):
+        deadline = time.monotonic() + self.config.imaging_ready_timeout
+        while True:
+            disk_type = dev.disc_type()
+            if disk_type == 'no-disc' or (disk_type not in ('drive-not-ready', 'no-info') and dev.test_unit_ready()):
+                return disk_type
+
+            if time.monotonic() >= deadline:
+                log.warn("Drive did not become ready in {} seconds, disc type is '{}'".format(self.config.imaging_ready_timeout, disk_type))
+                return disk_type
+
+            log.debug("Drive is not ready yet, disc type is '{}'".format(disk_type))
+            time.sleep(self.ready_poll_delay)
+
+    # Reference the image of a disc archived before instead of reading it again (see blobstore.py)
+    def reference_known_disc(self, dev, toc, capture_dir, capture_id, log):
+        try:
+            blobs = BlobStore(self.capture_basedir)
+            try:
+                entry = blobs.match(capture_dir, dev, toc, self.config.dedup_verify_samples, log)
+                if entry is None:
+                    return False
+                image = blobs.reference(capture_dir, capture_id, entry)
+            finally:
+                blobs.close()
+        except (OSError, sqlite3.Error) as e:
+            log.warn("Could not look up the disc in the blob store: {}".format(e))
+            return False
+
+        catalog.record(self.capture_basedir, capture_id, size=image['size'], checksums=image['digests'])
+        log.info("Disc was already archived in capture '{}', referencing its image instead of reading it".format(entry['capture_id']))
+        return True
+
+    def rescue_read(self, dev, toc, contents_dir, log, progress=None):
+        reader = RescueReader(dev, toc, self.config, log, progress)
+        bad_sectors = reader.image(os.path.join(contents_dir, 'data.bin'), os.path.join(contents_dir, 'data.map'))
+        write_toc(os.path.join(contents_dir, 'toc.txt'), reader.tracks)
+
+        if bad_sectors > self.config.imaging_max_bad_sectors:
+            log.error("{} sector(s) could not be read, see 'data.map'".format(bad_sectors))
+            return False
+        if bad_sectors > 0:
+            log.warn("{} sector(s) could not be read and were left zero-filled, see 'data.map'".format(bad_sectors))
+        return True
+
+    def run_cdrdao(self, contents_dir, output, log):
+        stderr = subprocess.STDOUT if output is not None else None
+        cmd = [ "cdrdao", "read-cd", "--device", self.device, "--datafile", "data.bin", "toc.txt" ]
+
+        if subprocess.call(cmd, cwd=contents_dir, stdout=output, stderr=stderr) == 0:
+            return True
+
+        log.warn("Disk could not be read normally (usually due to L-EC errors), attempting raw read instead")
+        for filename in ('toc.txt', 'data.bin'):
+            if os.path.exists(os.path.join(contents_dir, filename)):
+                os.unlink(os.path.join(contents_dir, filename))
+
+        return subprocess.call(cmd[:-1] + [ "--read-raw", "toc.txt" ], cwd=contents_dir, stdout=output, stderr=stderr) == 0
+
+# List the optical drives connected to the system
+def optical_devices():
+    proc = subprocess.run(['lsblk', '-J', '-d', '-p', '-o', 'NAME,TYPE'], stdout=subprocess.PIPE)
+    if proc.returncode != 0:
+        return []
+
+    return [ dev['name'] for dev in json.loads(proc.stdout.decode('utf-8'))['blockdevices'] if dev['type'] == 'rom' ]
+
+#
+# Find the drives listed in the 'drives' config entry which are connected to the system.
+# If no drives are configured a single drive on /dev/cdrom is used.
+#
+def discover_drives(config, capture_basedir="."):
+    log = logging.getLogger(__name__)
+
+    default_marker_ids = { 'disk_center': config.center_marker_id, 'disk_edge': config.edge_marker_id }
+
+    if not config.drives:
+        return [ Drive("/dev/cdrom", capture_basedir, config.drive_tray_pos, config.drive_tray_z_min, default_marker_ids, config) ]
+
+    present = [ os.path.realpath(dev) for dev in optical_devices() ]
+    log.debug("Optical drives present in the system: {}".format(present))
+
+    drives = []
+    for entry in config.drives:
+        device = entry['device']
+        if os.path.realpath(device) not in present:
+            log.warn("Configured drive '{}' is not present".format(device))
+            continue
+
+        marker_ids = {
+            'disk_center': entry.get('center_marker_id', config.center_marker_id),
+            'disk_edge': entry.get('edge_marker_id', config.edge_marker_id)
+        }
+        drives.append(Drive(device, capture_basedir, entry['tray_pos'], entry.get('tray_z_min', config.drive_tray_z_min), marker_ids, config))
+
+    configured = [ os.path.realpath(entry['device']) for entry in config.drives ]
+    for dev in present:
+        if dev not in configured:
+            log.warn("Drive '{}' has no tray position configured, ignoring".format(dev))
+
+    log.info("Using drives: {}".format([ drive.device for drive in drives ]))
+    return drives
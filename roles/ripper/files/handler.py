@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from motion import MotionPlanner
+from timing import null_timings
+
+#
+# The disc handling steps which make up a capture cycle. They are shared by
+# the ripper.py script (one process per disc) and the pipelined scheduler
+# in the brain which interleaves the steps of consecutive discs.
+#
+# The trays are referred to by name ('src', 'staging', 'done', 'error'), their positions
+# are taken from the '<name>_tray_pos' and '<name>_tray_z_min' config entries.
+#
+class DiscHandler:
+    def __init__(self, arm, config, display, stacks=None, covers=None):
+        self.arm = arm
+        self.config = config
+        self.display = display
+        self.stacks = stacks
+        self.covers = covers
+        self.motion = MotionPlanner(arm, config)
+        self.log = logging.getLogger(__name__)
+        self.timings = null_timings
+
+    def tray_pos(self, tray):
+        return getattr(self.config, '{}_tray_pos'.format(tray))
+
+    def tray_z_min(self, tray):
+        return getattr(self.config, '{}_tray_z_min'.format(tray))
+
+    def move_to(self, pos):
+        self.motion.move(pos)
+
+    # Move the arm away so that the camera can make a photo of the drive tray
+    def park(self):
+        with self.timings.span('park'):
+            self.move_to(self.config.src_tray_pos)
+
+    # Pick up a disc at 'pos', if 'tray' is given the stack model for this tray is used
+    def pickup(self, pos, z_min, tray=None):
+        with self.timings.span('pickup'):
+            return self.pickup_disc(pos, z_min, tray)
+
+    def pickup_disc(self, pos, z_min, tray):
+        z_hint = None
+        if self.stacks and tray:
+            z_hint = self.stacks.top(tray)
+
+        if not self.motion.pickup_object(pos, z_min, z_hint):
+            if self.stacks and tray:
+                self.stacks.empty(tray)
+            return False
+
+        if self.stacks and tray:
+            self.stacks.picked(tray, self.arm.contact_z())
+
+        self.motion.pump(True)
+        time.sleep(self.config.t_grab)
+        return True
+
+    def release(self):
+        self.motion.pump(False)
+        time.sleep(self.config.t_release)
+
+    # Carry a picked up disc from 'from_pos' to 'to_pos' and let go of it, if 'tray' is
+    # given the disc is lowered to the top of the stack in this tray before releasing it
+    def place(self, from_pos, to_pos, tray=None):
+        with self.timings.span('place'):
+            self.place_disc(from_pos, to_pos, tray)
+
+    def place_disc(self, from_pos, to_pos, tray):
+        drop_pos = tuple(to_pos)
+        if self.stacks and tray:
+            drop_pos = self.stacks.drop_pos(tray, to_pos)
+
+        self.motion.path([from_pos, to_pos, drop_pos])
+        self.release()
+
+        if self.stacks and tray:
+            self.stacks.dropped(tray)
+
+        # Get out of the tray before moving anywhere else
+        self.motion.move(to_pos, wait=False)
+
+    def close_tray(self, drive):
+        for i in range(self.config.close_tray_max_attempts):
+            if drive.close_tray():
+                return True
+
+            self.log.warn("Could not close drive tray, retry '{}' of '{}'".format(i, self.config.close_tray_max_attempts))
+            self.display.msg("ERR DRIVE CLOSE")
+            drive.open_tray()
+
+        return False
+
+    # Pick up a disc from a tray and put it into the drive, the tray is
+    # closed afterwards and the arm is moved away from the camera view
+    def load_drive(self, drive, tray):
+        tray_pos = self.tray_pos(tray)
+
+        # The drive tray opens while the arm is picking up the disc
+        drive.start_open_tray()
+
+        if not self.pickup(tray_pos, self.tray_z_min(tray), tray):
+            drive.open_tray()
+            drive.close_tray()
+            return False
+
+        self.display.msg("MOVE TO DRIVE")
+
+        with self.timings.span('place'):
+            self.motion.move(tray_pos, wait=False)
+            drive.open_tray()
+            self.motion.move(drive.tray_pos)
+            self.release()
+
+        self.park()
+
+        self.close_tray(drive)
+        return True
+
+    # Take the photo of the disc lying in the open drive tray. Returns a future for
+    # writing the cover image or None if the photo could not be taken. With cover
+    # workers the image is processed in the background, see wait_cover().
+    def photograph_cover(self, vision, cover_filename, calibration_markers):
+        image = vision.image_capture()
+        if not image:
+            self.log.error("Could not acquire image and write a cover file")
+            self.display.msg("ERR ACQ. COVER IMG")
+            return None
+
+        if self.covers is not None:
+            try:
+                return self.covers.submit(image, cover_filename, calibration_markers)
+            except BrokenProcessPool as e:
+                # A worker died, the pool won't take any more work so the covers are
+                # written in this process from now on
+                self.log.error("Cover workers failed, writing the covers synchronously: {}".format(e))
+                self.covers = None
+
+        future = Future()
+        try:
+            vision.write_cover_image(image, cover_filename, calibration_markers)
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    # Is it known already that the cover could not be written, the disc then goes to the
+    # 'error' tray. A cover written in the background can still fail, see wait_cover().
+    def cover_failed(self, future):
+        return future is None or (future.done() and future.exception() is not None)
+
+    def wait_cover(self, future):
+        try:
+            with self.timings.span('cover_wait'):
+                spans = future.result()
+            if spans:
+                self.timings.merge(spans)
+            return True
+        except Exception as e:
+            self.log.error("Could not write a cover file: {}".format(e))
+            self.display.msg("ERR COVER IMG")
+            return False
+
+    # Pick up the disc from the open drive tray and put it into the 'dest_tray' tray
+    def unload_drive(self, drive, dest_tray):
+        if not self.pickup(drive.tray_pos, drive.tray_z_min):
+            return False
+
+        self.display.msg("MOVE TO DST TRAY")
+
+        self.place(drive.tray_pos, self.tray_pos(dest_tray), dest_tray)
+
+        drive.close_tray()
+
+        self.motion.origin()
+        return True
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import ctypes
+import fcntl
+import os
+
+#
+# Talks to optical drives directly with SCSI MMC commands through the Linux SG_IO ioctl.
+# All of the information about the drive and the disc is read with the device opened
+# once, instead of running a tool (and spinning up the drive again) for each piece.
+#
+#   with MMCDevice('/dev/sr0') as dev:
+#       print(dev.inquiry(), dev.disc_type(), dev.read_toc())
+#
+
+SG_IO = 0x2285
+SG_DXFER_NONE = -1
+SG_DXFER_TO_DEV = -2
+SG_DXFER_FROM_DEV = -3
+SG_INFO_OK_MASK = 0x1
+
+# The CD-ROM ioctls from linux/cdrom.h
+CDROM_DISC_STATUS = 0x5327
+
+# The CDROM_DISC_STATUS results, named like the disk types of 'cdctl -g' in plastic-archiver.sh
+disc_types = {
+    0: 'no-info',
+    1: 'no-disc',
+    2: 'tray-open',
+    3: 'drive-not-ready',
+    100: 'audio-cd',
+    101: 'type-1-data',
+    102: 'type-2-data',
+    103: 'xa-2-1',
+    104: 'xa-2-2',
+    105: 'mixed',
+}
+
+# The track number of the lead-out area in the TOC
+lead_out_track = 0xaa
+
+class sg_io_hdr(ctypes.Structure):
+    _fields_ = [
+        ('interface_id', ctypes.c_int),
+        ('dxfer_direction', ctypes.c_int),
+        ('cmd_len', ctypes.c_ubyte),
+        ('mx_sb_len', ctypes.c_ubyte),
+        ('iovec_count', ctypes.c_ushort),
+        ('dxfer_len', ctypes.c_uint),
+        ('dxferp', ctypes.c_void_p),
+        ('cmdp', ctypes.c_void_p),
+        ('sbp', ctypes.c_void_p),
+        ('timeout', ctypes.c_uint),
+        ('flags', ctypes.c_uint),
+        ('pack_id', ctypes.c_int),
+        ('usr_ptr', ctypes.c_void_p),
+        ('status', ctypes.c_ubyte),
+        ('masked_status', ctypes.c_ubyte),
+        ('msg_status', ctypes.c_ubyte),
+        ('sb_len_wr', ctypes.c_ubyte),
+        ('host_status', ctypes.c_ushort),
+        ('driver_status', ctypes.c_ushort),
+        ('resid', ctypes.c_int),
+        ('duration', ctypes.c_uint),
+        ('info', ctypes.c_uint),
+    ]
+
+class MMCError(Exception):
+    def __init__(self, msg, sense_key=None, asc=None, ascq=None):
+        super().__init__(msg)
+        self.sense_key = sense_key
+        self.asc = asc
+        self.ascq = ascq
+
+class MMCDevice:
+    def __init__(self, device, timeout=30):
+        self.device = device
+        self.timeout = timeout # [s]
+        self.fd = None
+
+    def open(self):
+        # O_NONBLOCK lets the device be opened with no disc in the drive
+        self.fd = os.open(self.device, os.O_RDONLY | os.O_NONBLOCK)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Send the command, returns the data read from the drive or None for commands without data
+    def command(self, cdb, length=0, data=None):
+        cdb = bytes(cdb)
+        cdb_buf = ctypes.create_string_buffer(cdb, len(cdb))
+        sense_buf = ctypes.create_string_buffer(32)
+
+        hdr = sg_io_hdr()
+        hdr.interface_id = ord('S')
+        hdr.cmd_len = len(cdb)
+        hdr.cmdp = ctypes.addressof(cdb_buf)
+        hdr.mx_sb_len = len(sense_buf)
+        hdr.sbp = ctypes.addressof(sense_buf)
+        hdr.timeout = int(self.timeout * 1000)
+
+        if data is not None:
+            data_buf = ctypes.create_string_buffer(bytes(data), len(data))
+            hdr.dxfer_direction = SG_DXFER_TO_DEV
+            hdr.dxfer_len = len(data)
+            hdr.dxferp = ctypes.addressof(data_buf)
+        elif length > 0:
+            data_buf = ctypes.create_string_buffer(length)
+            hdr.dxfer_direction = SG_DXFER_FROM_DEV
+            hdr.dxfer_len = length
+            hdr.dxferp = ctypes.addressof(data_buf)
+        else:
+            data_buf = None
+            hdr.dxfer_direction = SG_DXFER_NONE
+
+        fcntl.ioctl(self.fd, SG_IO, hdr)
+
+        if hdr.info & SG_INFO_OK_MASK:
+            sense = sense_buf.raw[:hdr.sb_len_wr]
+            (sense_key, asc, ascq) = (None, None, None)
+            if len(sense) >= 14:
+                (sense_key, asc, ascq) = (sense[2] & 0x0f, sense[12], sense[13])
+            raise MMCError("Command {:02x} failed on '{}': status={:02x} host={:04x} driver={:04x} sense={}/{}/{}".format(
+                cdb[0], self.device, hdr.status, hdr.host_status, hdr.driver_status, sense_key, asc, ascq), sense_key, asc, ascq)
+
+        if data_buf is None or data is not None:
+            return None
+        return data_buf.raw[:length - hdr.resid]
+
+    # Read a response which starts with its own 2 byte length field
+    def read_sized(self, cdb, length_offset=7, max_length=0xfffe):
+        cdb = bytearray(cdb)
+        cdb[length_offset:length_offset + 2] = (4).to_bytes(2, 'big')
+        header = self.command(cdb, 4)
+        length = min(int.from_bytes(header[0:2], 'big') + 2, max_length)
+
+        cdb[length_offset:length_offset + 2] = length.to_bytes(2, 'big')
+        return self.command(cdb, length)
+
+    # TEST UNIT READY, False while the drive is becoming ready or has no disc
+    def test_unit_ready(self):
+        try:
+            self.command([ 0x00, 0, 0, 0, 0, 0 ])
+        except MMCError:
+            return False
+        return True
+
+    def inquiry(self):
+        data = self.command([ 0x12, 0, 0, 0, 96, 0 ], 96)
+        return {
+            'vendor': data[8:16].decode('ascii', 'replace').strip(),
+            'product': data[16:32].decode('ascii', 'replace').strip(),
+            'revision': data[32:36].decode('ascii', 'replace').strip(),
+        }
+
+    def disc_type(self):
+        status = fcntl.ioctl(self.fd, CDROM_DISC_STATUS)
+        return disc_types.get(status, 'unknown-{}'.format(status))
+
+    # The tracks from the formatted TOC, the lead-out is the last entry
+    def read_toc(self):
+        data = self.read_sized([ 0x43, 0, 0, 0, 0, 0, 0, 0, 0, 0 ])
+
+        tracks = []
+        for offset in range(4, len(data) - 7, 8):
+            descriptor = data[offset:offset + 8]
+            tracks.append({
+                'track': descriptor[2],
+                'adr': descriptor[1] >> 4,
+                'control': descriptor[1] & 0x0f,
+                'data': bool(descriptor[1] & 0x04),
+                'lba': int.from_bytes(descriptor[4:8], 'big', signed=True),
+            })
+        return tracks
+
+    # The raw full TOC (Q sub-channel data of the lead-in), as read by 'readom -fulltoc'
+    def read_full_toc(self):
+        return self.read_sized([ 0x43, 0x02, 0x02, 0, 0, 0, 1, 0, 0, 0 ])
+
+    def read_disc_information(self):
+        data = self.read_sized([ 0x51, 0, 0, 0, 0, 0, 0, 0, 0, 0 ])
+        return {
+            'erasable': bool(data[2] & 0x10),
+            'last_session_status': (data[2] >> 2) & 0x03,
+            'disc_status': data[2] & 0x03,
+            'first_track': data[3],
+            'sessions': data[4] | (data[9] << 8 if len(data) > 9 else 0),
+            'disc_type': data[8] if len(data) > 8 else None,
+        }
+
+    # Read the sectors with READ CD, user data only (2048 bytes for data sectors, 2352 for
+    # audio) or the whole raw 2352 byte sector including the sync pattern, header and ECC
+    def read_cd(self, lba, count, sector_size=2048, raw=False):
+        flags = 0x10
+        if raw:
+            (flags, sector_size) = (0xf8, 2352)
+        cdb = [ 0xbe, 0 ] + list(lba.to_bytes(4, 'big')) + list(count.to_bytes(3, 'big')) + [ flags, 0, 0 ]
+        return self.command(cdb, count * sector_size)
+
+    # Read speed in kB/s, 0xffff selects the maximum speed of the drive
+    def set_speed(self, speed):
+        self.command([ 0xbb, 0 ] + list(int(speed).to_bytes(2, 'big')) + [ 0xff, 0xff, 0, 0, 0, 0, 0, 0 ])
+
+def hex_bytes(data):
+    return " ".join("{:02x}".format(b) for b in data)
+
+# The full TOC as hex lines, the header and then one 11 byte descriptor per line
+def full_toc_hex(data):
+    lines = [ hex_bytes(data[0:4]) ]
+    lines += [ hex_bytes(data[offset:offset + 11]) for offset in range(4, len(data) - 10, 11) ]
+    return "\n".join(lines) + "\n"
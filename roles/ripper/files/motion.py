@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import logging
+import math
+
+def dist(a,b):
+    return math.sqrt( (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2 )
+
+#
+# A thin layer over UArm (or ArmClient) which sends whole paths to the arm at once and
+# leaves out the commands that would not change anything. The firmware queues the moves,
+# so a path is sent back-to-back and waited for only once at the end. The intermediate
+# waypoints use 'path_transit_speed', the last one the requested speed.
+#
+# The state of the arm (position, pump, grip and wrist servo) is cached, moves to the
+# position the arm is already at and commands setting the state it already has are dropped.
+# Anything which moves the arm behind the back of the planner needs to call invalidate().
+#
+class MotionPlanner:
+    origin_pos = (0, 150, 100)
+    origin_wrist_angle = 90
+
+    def __init__(self, arm, config):
+        self.arm = arm
+        self.config = config
+        self.log = logging.getLogger(__name__)
+
+        self.position = None
+        self.pump_state = None
+        self.grip_state = None
+        self.wrist_angle = None
+
+    def invalidate(self):
+        self.position = None
+
+    def at(self, pos):
+        if self.position is None:
+            p = self.arm.pos()
+            if p is None:
+                return False
+            self.position = tuple(p)
+
+        return dist(self.position, pos) <= self.config.motion_position_tolerance
+
+    def path(self, waypoints, speed=None, wait=True):
+        moves = []
+        for p in waypoints:
+            if moves:
+                if dist(moves[-1], p) <= self.config.motion_position_tolerance:
+                    continue
+            elif self.at(p):
+                continue
+            moves.append(tuple(p))
+
+        if len(moves) < len(waypoints):
+            self.log.debug("Dropped {} redundant waypoint(s) from path {}".format(len(waypoints) - len(moves), waypoints))
+
+        for i, p in enumerate(moves):
+            s = speed if i == len(moves) - 1 else self.config.path_transit_speed
+            if s is None:
+                self.arm.move_abs(p)
+            else:
+                self.arm.move_abs(p, s)
+            self.position = p
+
+        if moves and wait:
+            self.arm.wait_for_move_end()
+
+        return len(moves)
+
+    def move(self, pos, speed=None, wait=True):
+        return self.path([pos], speed, wait)
+
+    def wait(self):
+        self.arm.wait_for_move_end()
+
+    def pump(self, state):
+        if self.pump_state != state:
+            self.arm.pump(state)
+            self.pump_state = state
+
+    def grip(self, state):
+        if self.grip_state != state:
+            self.arm.grip(state)
+            self.grip_state = state
+
+    def origin(self, wait=False):
+        self.pump(False)
+        self.grip(False)
+        self.move(self.origin_pos, 0, wait=False)
+
+        if self.wrist_angle != self.origin_wrist_angle:
+            self.arm.servo_abs(3, self.origin_wrist_angle)
+            self.wrist_angle = self.origin_wrist_angle
+
+        if wait:
+            self.wait()
+
+    def pickup_object(self, pos, z_min, z_hint=None):
+        result = self.arm.pickup_object(pos, z_min, z_hint)
+        self.invalidate()
+        return result
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from handler import DiscHandler
+from stacks import StackModel
+from timing import Timings, Metrics, null_timings
+import catalog
+
+log = logging.getLogger(__name__)
+
+#
+# The log format mimics 'journalctl -o short-iso' so that the per-capture log.txt
+# files look the same as the ones stored for ripper.py units.
+#
+capture_log_format = "%(asctime)s {} brain.py[%(process)d]: %(levelname)s:%(name)s:%(message)s".format(socket.gethostname())
+capture_log_datefmt = "%Y-%m-%dT%H:%M:%S%z"
+
+# The components call fatal() which LoggerAdapter doesn't have
+class CaptureLogAdapter(logging.LoggerAdapter):
+    def fatal(self, msg, *args, **kwargs):
+        self.critical(msg, *args, **kwargs)
+
+class Capture:
+    def __init__(self, storage_path, config):
+        self.config = config
+        self.id = str(uuid.uuid4())
+        self.storage_path = storage_path
+        self.dir = "{}/{}".format(storage_path, self.id)
+        self.debugcam_unit_name = 'debugcam@{}.service'.format(self.id)
+
+        # Messages about this capture are logged with this adapter so that they
+        # don't end up in log files of other captures running at the same time
+        self.log = self.logger(__name__)
+        self.timings = Timings()
+        self.start_time = time.time()
+        self.start = time.monotonic()
+
+        os.mkdir(self.dir)
+
+        self.log_file = open("{}/log.txt".format(self.dir), "a")
+        self.log_file.write("-- Capture '{}' log begins --\n".format(self.id))
+        self.log_file.flush()
+
+        self.log_handler = logging.StreamHandler(self.log_file)
+        self.log_handler.setFormatter(logging.Formatter(capture_log_format, capture_log_datefmt))
+        self.log_handler.addFilter(self.log_filter)
+        logging.getLogger(None).addHandler(self.log_handler)
+
+        catalog.record_start(self.storage_path, self.id, self.start_time)
+
+        self.log.info("Starting debugcam for capture id '{}'".format(self.id))
+        subprocess.call(['sudo', 'systemd-run', '--uid', str(os.getuid()), '--unit', self.debugcam_unit_name, 'record.sh', self.config.debugcam_device, self.dir])
+
+    # The logger of a module tagging the messages with this capture
+    def logger(self, name):
+        return CaptureLogAdapter(logging.getLogger(name), { 'capture_id': self.id })
+
+    # Only the messages about this capture go into its log file
+    def log_filter(self, record):
+        return getattr(record, 'capture_id', None) == self.id
+
+    def finish(self, result):
+        subprocess.call(['sudo', 'systemctl', 'stop', self.debugcam_unit_name])
+        os.system("journalctl -a --utc -o short-iso _SYSTEMD_UNIT={} > {}/debugcam-log.txt".format(self.debugcam_unit_name, self.dir))
+
+        self.timings.add('capture', self.start_time, time.monotonic() - self.start)
+        self.timings.dump("{}/timings.json".format(self.dir))
+        Metrics(self.config).add_capture(self.timings, result)
+        catalog.record_finish(self.storage_path, self.id, result, self.start_time, self.timings)
+
+        self.log.info("Capture '{}' finished".format(self.id))
+
+        logging.getLogger(None).removeHandler(self.log_handler)
+        self.log_handler.close()
+        self.log_file.close()
+
+#
+# The pipelined scheduler runs the whole capture cycle inside of the brain process.
+# Each disc picked up from the source tray goes to whichever drive is free. When all
+# of the drives are busy imaging the arm stages the next disc from the source tray onto
+# the staging tray (if there is one). As soon as a drive finishes imaging, its disc is
+# unloaded and the drive is fed with the staged disc right away.
+#
+class Pipeline:
+    def __init__(self, arm, drives, vision, display, config, storage_path, covers=None, calibration=None):
+        self.arm = arm
+        self.drives = drives
+        self.vision = vision
+        self.display = display
+        self.config = config
+        self.storage_path = storage_path
+        self.calibration = calibration
+
+        self.handler = DiscHandler(arm, config, display, StackModel(config), covers)
+
+        # The captures for the discs currently in the drives, indexed by drive device
+        self.captures = dict()
+        # Is there a disc waiting on the staging tray
+        self.staged = False
+        # The number of discs in a row which could not be loaded
+        self.load_failures = 0
+
+    def stage(self):
+        log.info("Staging next disc from source tray")
+        self.display.msg("STAGE NEXT DISK")
+
+        if not self.handler.pickup(self.config.src_tray_pos, self.config.src_tray_z_min, 'src'):
+            log.error("Could not pick up disk for staging")
+            self.display.msg("ERR PICKUP DISK")
+            self.handler.motion.origin()
+            self.handler.park()
+            return
+
+        self.handler.place(self.config.src_tray_pos, self.config.staging_tray_pos, 'staging')
+        self.staged = True
+
+        self.handler.park()
+
+        self.display.msg("IMAGING ...")
+
+    # Record the stage timings and the log messages into the capture the arm is working
+    # on (or none of them with no capture), the drive records them for as long as the
+    # disc is inside
+    def use_capture(self, capture, drive=None):
+        timings = capture.timings if capture is not None else null_timings
+        self.handler.timings = timings
+        self.arm.timings = timings
+        self.vision.timings = timings
+        if drive is not None:
+            drive.timings = timings
+
+        components = [ self.handler, self.handler.stacks, self.handler.motion, self.arm, self.vision, self.vision.camera, self.calibration, drive ]
+        for component in components:
+            if component is None:
+                continue
+            name = type(component).__module__
+            component.log = capture.logger(name) if capture is not None else logging.getLogger(name)
+
+    def load(self, drive):
+        tray = 'staging' if self.staged else 'src'
+
+        capture = Capture(self.storage_path, self.config)
+        capture.log.info("Starting capture '{}' in drive '{}'".format(capture.id, drive.device))
+        self.use_capture(capture, drive)
+
+        capture.log.info("Picking up disk from '{}' tray".format(tray))
+        self.display.msg("PICKUP SRC TRAY")
+
+        if not self.handler.load_drive(drive, tray):
+            capture.log.error("Could not pick up disk")
+            self.display.msg("ERR PICKUP DISK")
+            self.handler.motion.origin()
+            self.use_capture(None, drive)
+            capture.finish('error')
+
+            # Whatever is left on the staging tray can't be picked up, the next
+            # disc comes from the source tray
+            if tray == 'staging':
+                capture.log.warn("Giving up on the disc on the staging tray")
+                self.staged = False
+
+            self.load_failures += 1
+            return False
+
+        self.staged = False
+        self.load_failures = 0
+        self.captures[drive.device] = capture
+
+        capture.log.info("Archiving disc in drive tray")
+        self.display.msg("IMAGING ...")
+
+        drive.start_read(capture.id, output=capture.log_file)
+        self.use_capture(None)
+
+        # All of the trays are closed and the arm is parked now
+        if self.calibration is not None:
+            self.calibration.disc_loaded()
+            self.handler.motion.invalidate()
+
+        return True
+
+    def unload(self, drive):
+        capture = self.captures[drive.device]
+        dest_tray = 'done'
+        self.use_capture(capture, drive)
+
+        if not drive.wait_read():
+            capture.log.error("Disk could not be imaged, putting into FAILED tray")
+            self.display.msg("IMAGING FAIL")
+            dest_tray = 'error'
+        else:
+            capture.log.info("Disc successfuly imaged, putting to DONE tray")
+
+        drive.open_tray()
+
+        # The cover image is written while the arm unloads the drive
+        cover = self.handler.photograph_cover(self.vision, '{}/cover.png'.format(capture.dir), drive.calibration_markers)
+        if self.handler.cover_failed(cover):
+            dest_tray = 'error'
+
+        if not self.handler.unload_drive(drive, dest_tray):
+            capture.log.fatal("Could not pick up CD, bailing out")
+            self.display.msg("ERR DISK PICKUP")
+            sys.exit(1)
+
+        if cover is not None:
+            if self.handler.wait_cover(cover):
+                capture.log.info("Cover image written")
+            elif dest_tray != 'error':
+                # The disc is in the DONE tray already, the capture still failed
+                capture.log.error("Cover image of the disc put to DONE tray could not be written")
+                dest_tray = 'error'
+
+        self.use_capture(None, drive)
+        capture.finish(dest_tray)
+        del self.captures[drive.device]
+
+    def run(self):
+        waiting = False
+
+        while True:
+            # Unload the drives which have finished imaging
+            for drive in self.drives:
+                if drive.device in self.captures and not drive.read_running():
+                    self.unload(drive)
+
+            free_drives = [ drive for drive in self.drives if drive.device not in self.captures ]
+
+            if free_drives:
+                if self.staged or self.arm.disc_present():
+                    waiting = False
+                    if not self.load(free_drives[0]):
+                        if self.load_failures >= self.config.pipeline_max_load_failures:
+                            log.fatal("Could not load {} discs in a row, bailing out".format(self.load_failures))
+                            self.display.msg("ERR DISK PICKUP")
+                            sys.exit(1)
+
+                        # Back off longer after each failure in a row
+                        time.sleep(self.config.pipeline_poll_delay * self.load_failures)
+                    continue
+
+                if not self.captures and not waiting:
+                    log.info("Waiting for a disc to be placed in the source tray")
+                    self.display.msg("WAITING FOR DISK IN SOURCE TRAY")
+                    waiting = True
+
+            # Use the time the drives spend imaging to get the next disc ready
+            elif self.config.staging_tray_pos is not None and not self.staged and self.arm.disc_present():
+                self.stage()
+                continue
+
+            time.sleep(self.config.pipeline_poll_delay)
@@ -8,11 +8,22 @@ log4bash_timefmt="+%Y-%m-%dT%H:%M:%S%z"
 # Default configuration
 CAPTURE_BASEDIR=.
 CAPTURE_ID=$(uuidgen)
+DIGEST_OPTS=()
+DEDUP_SAMPLES=
 
-usage() { echo "Usage: $0 [-i <CAPTURE_ID>] [-o <capture_basedir>] <reader_device>" 1>&2; exit 1; }
+usage() { echo "Usage: $0 [-i <CAPTURE_ID>] [-o <capture_basedir>] [-a <digest_algorithm>]... [-z] [-d <verify_samples>] <reader_device>" 1>&2; exit 1; }
 
-while getopts ":i:o:R" o; do
+while getopts ":i:o:a:zd:R" o; do
     case "${o}" in
+        d)
+            DEDUP_SAMPLES="$OPTARG"
+            ;;
+        a)
+            DIGEST_OPTS+=(-a "$OPTARG")
+            ;;
+        z)
+            DIGEST_OPTS+=(-z)
+            ;;
         o)
             CAPTURE_BASEDIR="$OPTARG"
             ;;
@@ -36,11 +47,12 @@ context_push "dev='$reader_device'"
 export CDROM="$reader_device" # Export env for cdctl command (see man cdctl)
 
 capture_dir="$CAPTURE_BASEDIR/$CAPTURE_ID"
+catalog_storage=$(realpath "$CAPTURE_BASEDIR")
 mkdir -p "$capture_dir"; pushd "$capture_dir" 2> /dev/null
 
-# Empty metadata file just to mark that spec v0 is being used,
-# in later versions this file may contain other info.
-touch metadata-v0
+# The metadata without the image marks that spec v1 is being used,
+# the image digests are added once the image is read (see digest.py)
+echo '{ "version": 1, "image": null }' > metadata-v1.json
 
 mkdir "reader"
 lsblk -O -J "$reader_device" | jq ' .blockdevices | .[0]' > reader/reader.json
@@ -48,6 +60,15 @@ cdrdao drive-info --device "$reader_device" > reader/mmc-drive-info.txt
 
 log_info "Storing info to '$capture_dir'"
 
+# Record the start and end time of a stage for the capture timings (see timing.py)
+readonly timings_file="$PWD/archiver-timings.txt"
+stage_start() { stage_start_time=$(date +%s.%N); }
+stage_end() { echo "$1 $stage_start_time $(date +%s.%N)" >> "$timings_file"; }
+
+# Record what is known about the capture in the catalog (see catalog.py)
+catalog_set() { catalog.py -s "$catalog_storage" set "$CAPTURE_ID" "$@" || log_warning "Could not update the catalog"; }
+
+stage_start
 disk_type=$(cdctl -g |
                 sed -e 's|There is no CD/DVD in the drive (no disc)\.|no-disc|' \
                     -e 's|There is an audio CD/DVD in the drive.|audio-cd|' \
@@ -56,6 +77,7 @@ disk_type=$(cdctl -g |
 
 log_debug "Detected disk type is '$disk_type'"
 echo "$disk_type" > disk-type.txt
+catalog_set "disk_type=$disk_type"
 
 # Read RAW TOC in hex
 readom "dev=$reader_device" -fulltoc 2>&1 | grep -E "^[0-9A-Fa-f ]+" > toc.hex
@@ -70,6 +92,7 @@ session_count=$(echo "$disk_info" | grep Sessions | awk '{print $3;}')
 
 toc=$(cdctl --list)
 echo "$toc" > toc.txt
+stage_end toc_read
 log_info "Disc contains $session_count session(s), TOC has $(echo "$toc" | grep -F audio | wc -l) audio tracks + $(echo "$toc" | grep -F data | wc -l) data tracks ($(echo "$toc" | wc -l) tracks total)"
 
 if [ $session_count -gt 1 ]; then
@@ -80,6 +103,19 @@ fi
 
 mkdir contents
 
+# A disc archived before references the archived image instead of being read again (see blobstore.py)
+if [ -n "$DEDUP_SAMPLES" ]; then
+    stage_start
+    if blobstore.py -s "$catalog_storage" -n "$DEDUP_SAMPLES" match "$CAPTURE_ID" "$reader_device" > /dev/null; then
+        stage_end fingerprint
+        log_info "Disc was already archived, referencing its image instead of reading it"
+        catalog_set $(jq -r '.image | select(. != null) | "size=\(.size)", (.digests | to_entries[] | "checksum.\(.key)=\(.value)")' metadata-v1.json)
+        popd
+        exit 0
+    fi
+    stage_end fingerprint
+fi
+
 readonly cdrdao_tocfile=toc.txt
 readonly cdrdao_datafile=data.bin
 
@@ -98,7 +134,17 @@ case $disk_type in
         ;;
     audio-cd|type-1-data)
         pushd contents 2> /dev/null
+        # The image is hashed (and compressed) while cdrdao writes it
+        digest.py "${DIGEST_OPTS[@]}" -m ../metadata-v1.json "$cdrdao_datafile" > /dev/null &
+        digest_pid=$!
+        trap 'kill $digest_pid 2> /dev/null' EXIT
+        stage_start
         run_cdrdao
+        stage_end data_read
+        stage_start
+        kill -USR1 $digest_pid; wait $digest_pid
+        stage_end digest
+        catalog_set $(jq -r '.image | select(. != null) | "size=\(.size)", (.digests | to_entries[] | "checksum.\(.key)=\(.value)")' ../metadata-v1.json)
         popd
         ;;
     *)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+from mmc import MMCError, lead_out_track
+
+#
+# Images a disc sector by sector in the manner of ddrescue. The first pass reads the
+# whole disc in large chunks at full speed, a chunk which fails is marked bad and the
+# reader skips ahead (further after each consecutive failure) so that it does not grind
+# through a damaged area. The following passes retry only the sectors which were skipped
+# or failed at reduced speed, one by one, the last attempt for data sectors is a raw read
+# which returns the sector even with an uncorrectable L-EC error.
+#
+# The state of each sector is kept in the map file next to the image so the damaged
+# areas of the disc can be seen afterwards:
+#
+#   # lba count status
+#   0 102343 +
+#   102343 12 -
+#
+# The image has the same layout as the data file written by 'cdrdao read-cd': 2048 byte
+# sectors for the data tracks and 2352 byte big endian samples for the audio tracks.
+#
+
+# The sector states
+untried = ord('?')
+good = ord('+')
+bad = ord('-')
+
+audio_sector_size = 2352
+data_sector_size = 2048
+# The user data in a raw mode 1 sector follows the sync pattern and the header
+raw_data_offset = 16
+
+# The read speed set with SET CD SPEED is in kB/s, 1x is 176.4 kB/s
+max_speed = 0xffff
+
+class Track:
+    def __init__(self, number, start, count, data, offset):
+        self.number = number
+        self.start = start
+        self.count = count
+        self.data = data
+        # The position of the first sector of the track in the image file
+        self.offset = offset
+        self.sector_size = data_sector_size if data else audio_sector_size
+
+    def position(self, lba):
+        return self.offset + (lba - self.start) * self.sector_size
+
+# The tracks of the TOC with their positions in the image
+def image_tracks(toc):
+    tracks = []
+    offset = 0
+    for (entry, next_entry) in zip(toc, toc[1:]):
+        if entry['track'] == lead_out_track:
+            continue
+        track = Track(entry['track'], entry['lba'], next_entry['lba'] - entry['lba'], entry['data'], offset)
+        tracks.append(track)
+        offset += track.count * track.sector_size
+    return tracks
+
+class RescueReader:
+    def __init__(self, dev, toc, config, log=None, progress=None):
+        self.dev = dev
+        self.config = config
+        self.log = log or logging.getLogger(__name__)
+        # Called with the size of the beginning of the image which was read completely
+        self.progress = progress
+
+        self.tracks = image_tracks(toc)
+        self.size = sum(track.count * track.sector_size for track in self.tracks)
+        self.map = bytearray([ untried ]) * sum(track.count for track in self.tracks)
+        self.first_lba = self.tracks[0].start if self.tracks else 0
+        self.good_prefix = 0
+
+    def status(self, lba, count=1):
+        return self.map[lba - self.first_lba:lba - self.first_lba + count]
+
+    def mark(self, lba, count, state):
+        self.map[lba - self.first_lba:lba - self.first_lba + count] = bytes([ state ]) * count
+
+        if self.progress is not None and self.good_prefix < len(self.map) and self.map[self.good_prefix] == good:
+            while self.good_prefix < len(self.map) and self.map[self.good_prefix] == good:
+                self.good_prefix += 1
+            self.progress(self.image_position(self.first_lba + self.good_prefix))
+
+    # The position of the sector in the image file, the end of the image past the last sector
+    def image_position(self, lba):
+        for track in self.tracks:
+            if lba < track.start + track.count:
+                return track.position(lba)
+        return self.size
+
+    def bad_sectors(self):
+        return self.map.count(bad) + self.map.count(untried)
+
+    def write_map(self, filename):
+        lines = [ "# lba count status" ]
+        start = 0
+        for n in range(1, len(self.map) + 1):
+            if n == len(self.map) or self.map[n] != self.map[start]:
+                lines.append("{} {} {}".format(self.first_lba + start, n - start, chr(self.map[start])))
+                start = n
+
+        with open(filename + ".tmp", 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(filename + ".tmp", filename)
+
+    def read(self, track, lba, count, raw=False):
+        if raw:
+            data = self.dev.read_cd(lba, count, raw=True)
+            return b''.join(data[n * audio_sector_size + raw_data_offset:n * audio_sector_size + raw_data_offset + data_sector_size]
+                            for n in range(count))
+
+        data = self.dev.read_cd(lba, count, track.sector_size)
+        if track.data:
+            return data
+
+        # The drive returns little endian samples, cdrdao stores them big endian
+        swapped = bytearray(len(data))
+        swapped[0::2] = data[1::2]
+        swapped[1::2] = data[0::2]
+        return bytes(swapped)
+
+    def try_read(self, fd, track, lba, count, raw=False):
+        try:
+            data = self.read(track, lba, count, raw)
+        except MMCError as e:
+            self.log.debug("Could not read {} sector(s) at {}: {}".format(count, lba, e))
+            return False
+
+        os.pwrite(fd, data, track.position(lba))
+        self.mark(lba, count, good)
+        return True
+
+    def set_speed(self, speed):
+        try:
+            self.dev.set_speed(speed)
+        except MMCError as e:
+            self.log.warn("Could not set the read speed to {} kB/s: {}".format(speed, e))
+
+    def image(self, filename, map_filename):
+        # The image is zero-filled up front, nothing of it is final until its beginning is read
+        if self.progress is not None:
+            self.progress(0)
+
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # The sectors which cannot be read stay zero-filled
+            os.ftruncate(fd, self.size)
+
+            self.set_speed(max_speed)
+            self.copy_pass(fd, map_filename)
+
+            if self.bad_sectors() > 0:
+                self.log.warn("{} sector(s) could not be read at full speed, retrying at {} kB/s".format(self.bad_sectors(), self.config.imaging_retry_speed))
+                self.set_speed(self.config.imaging_retry_speed)
+                self.retry_pass(fd, map_filename)
+                self.set_speed(max_speed)
+        finally:
+            os.close(fd)
+            self.write_map(map_filename)
+
+        return self.bad_sectors()
+
+    def copy_pass(self, fd, map_filename):
+        chunk = self.config.imaging_chunk_sectors
+
+        for track in self.tracks:
+            lba = track.start
+            skip = chunk
+            while lba < track.start + track.count:
+                count = min(chunk, track.start + track.count - lba)
+                if self.try_read(fd, track, lba, count):
+                    lba += count
+                    skip = chunk
+                    continue
+
+                self.mark(lba, count, bad)
+                self.log.warn("Read error in track {} at sector {}, skipping {} sector(s)".format(track.number, lba, skip))
+                lba += count + skip
+                skip = min(skip * 2, self.config.imaging_max_skip_sectors)
+                self.write_map(map_filename)
+
+    def retry_pass(self, fd, map_filename):
+        chunk = self.config.imaging_chunk_sectors
+
+        for track in self.tracks:
+            end = track.start + track.count
+            lba = track.start
+            while lba < end:
+                state = self.status(lba)[0]
+                if state == good:
+                    lba += 1
+                    continue
+
+                # The skipped areas are tried in chunks first, most of them are readable
+                if state == untried:
+                    count = 1
+                    while count < chunk and lba + count < end and self.status(lba + count)[0] == untried:
+                        count += 1
+                    if self.try_read(fd, track, lba, count):
+                        lba += count
+                        continue
+
+                self.retry_sector(fd, track, lba)
+                lba += 1
+
+            self.write_map(map_filename)
+
+    def retry_sector(self, fd, track, lba):
+        for attempt in range(self.config.imaging_retries):
+            if self.try_read(fd, track, lba, 1):
+                return
+
+        if not (track.data and self.try_read(fd, track, lba, 1, raw=True)):
+            self.mark(lba, 1, bad)
+
+def msf(frames):
+    return "{:02d}:{:02d}:{:02d}".format(frames // (60 * 75), (frames // 75) % 60, frames % 75)
+
+# The cdrdao TOC file describing the image, as written by 'cdrdao read-cd'
+def write_toc(filename, tracks):
+    lines = [ "CD_ROM" if any(track.data for track in tracks) else "CD_DA", "" ]
+    for track in tracks:
+        lines.append("// Track {}".format(track.number))
+        if track.data:
+            lines.append("TRACK MODE1")
+            lines.append('DATAFILE "data.bin" #{} {}'.format(track.offset, msf(track.count)))
+        else:
+            lines.append("TRACK AUDIO")
+            lines.append('FILE "data.bin" #{} 0 {}'.format(track.offset, msf(track.count)))
+        lines.append("")
+
+    with open(filename, 'w') as f:
+        f.write("\n".join(lines))
@@ -8,15 +8,22 @@ import os
 import json
 import argparse
 from uarm import UArm
+from armlink import ArmClient
 from vision import Vision
-from drive import Drive
+from drive import discover_drives
 from storage import Storage
 from display import Display
+from handler import DiscHandler
+from stacks import StackModel
+from timing import Timings, Metrics
+import catalog
 
 import config
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--arm-device", dest='device', help="UArm serial port device")
+parser.add_argument("--arm-socket", dest='socket', help="Use the UArm through the brain listening on this socket")
+parser.add_argument("--drive-device", dest="drive_device", help="Drive device used for imaging")
 parser.add_argument("--capture-id", dest="capture_id", help="Capture ID")
 parser.add_argument("--storage-path", dest="storage_path", help="Storage root path")
 parser.add_argument("--calibration-markers", dest="calibration_markers_file", help="Calibration marker positions")
@@ -29,11 +36,15 @@ rootlog = logging.getLogger(None)
 
 display = Display(config)
 
-arm = UArm(serial.Serial(port=args.device, baudrate=115200, timeout=config.serial_port_timeout), config)
-if arm.connect():
-    log.info("Detected UArm on device {}".format(args.device))
+if args.socket:
+    arm = ArmClient(args.socket)
+    log.info("Using UArm through socket '{}'".format(args.socket))
 else:
-    log.fatal("Could not connect to UArm using device '{}'".format(args.device))
+    arm = UArm(serial.Serial(port=args.device, baudrate=115200, timeout=config.serial_port_timeout), config)
+    if arm.connect():
+        log.info("Detected UArm on device {}".format(args.device))
+    else:
+        log.fatal("Could not connect to UArm using device '{}'".format(args.device))
 
 storage_path = args.storage_path
 capture_id = args.capture_id
@@ -42,101 +53,82 @@ log.info("Using storage '{}'".format(storage_path))
 
 vision = Vision(config)
 
-drive = Drive("/dev/cdrom", storage_path)
+drives = discover_drives(config, storage_path)
+drive = None
+for d in drives:
+    if d.device == args.drive_device:
+        drive = d
+
+if drive is None:
+    log.fatal("Drive '{}' was not discovered, bailing out".format(args.drive_device))
+    sys.exit(1)
+
+log.info("Using drive '{}'".format(drive.device))
 
 calibration_markers = None
 with open(args.calibration_markers_file, 'r') as f:
-    calibration_markers = json.load(f)
+    calibration_markers = json.load(f)[drive.device]
 
 log.info("Calibration data loaded from '{}': {}".format(args.calibration_markers_file, calibration_markers))
 
 log.info("Starting capture")
 
+handler = DiscHandler(arm, config, display, StackModel(config))
+
+# The time spent in each stage of the capture
+timings = Timings()
+handler.timings = timings
+arm.timings = timings
+drive.timings = timings
+vision.timings = timings
+
+capture_start_time = time.time()
+capture_start = time.monotonic()
+catalog.record_start(storage_path, capture_id, capture_start_time)
+
+def finish(result):
+    timings.add('capture', capture_start_time, time.monotonic() - capture_start)
+    timings.dump('{}/{}/timings.json'.format(storage_path, capture_id))
+    Metrics(config).add_capture(timings, result)
+    catalog.record_finish(storage_path, capture_id, result, capture_start_time, timings)
+
 log.info("Picking up disk from source tray")
 display.msg("PICKUP SRC TRAY")
 
-# Pickup disk
-cd_pickedup = arm.pickup_object(config.src_tray_pos, config.src_tray_z_min)
-if not cd_pickedup:
+if not handler.load_drive(drive, 'src'):
     log.fatal("Could not pick up disk, bailing out")
     display.msg("ERR PICKUP DISK")
+    finish('error')
     sys.exit(1)
 
-arm.pump(True)
-time.sleep(config.t_grab)
-
-display.msg("MOVE TO DRIVE")
-
-arm.move_abs(config.src_tray_pos)
-arm.wait_for_move_end()
-
-drive.open_tray()
-
-arm.move_abs(config.drive_tray_pos)
-arm.wait_for_move_end()
-
-arm.pump(False)
-time.sleep(config.t_release)
-
-arm.origin()
-
-for i in range(config.close_tray_max_attempts):
-    if drive.close_tray():
-        break
-
-    log.warn("Could not close drive tray, retry '{}' of '{}'".format(i, config.close_tray_max_attempts))
-    display.msg("ERR DRIVE CLOSE")
-    drive.open_tray()
-
-# Move the arm away so that the camera can make a photo of the disc
-arm.move_abs(config.src_tray_pos)
-
 log.info("Archiving disc in drive tray")
 display.msg("IMAGING ...")
 
-dest_tray = config.done_tray_pos
+dest_tray = 'done'
 
 if not drive.read_disc(capture_id):
     log.error("Disk could not be imaged, putting into FAILED tray")
     display.msg("IMAGING FAIL")
-    dest_tray = config.error_tray_pos
+    dest_tray = 'error'
 else:
     log.info("Disc successfuly imaged, putting to DONE tray")
 
 drive.open_tray()
 
-try:
-    tmp_image_filename = vision.image_acquire()
-    vision.write_cover_image(tmp_image_filename, '{}/{}/cover.png'.format(storage_path, capture_id), calibration_markers)
-except:
-    log.error("Could not acquire image and write a cover file")
-    display.msg("ERR ACQ. COVER IMG")
-    dest_tray = config.error_tray_pos
-finally:
-    if tmp_image_filename:
-        os.unlink(tmp_image_filename)
-
-cd_pickedup = arm.pickup_object(config.drive_tray_pos, config.drive_tray_z_min)
-if not cd_pickedup:
+# The cover image is written while the arm unloads the drive
+cover = handler.photograph_cover(vision, '{}/{}/cover.png'.format(storage_path, capture_id), calibration_markers)
+if handler.cover_failed(cover):
+    dest_tray = 'error'
+
+if not handler.unload_drive(drive, dest_tray):
     log.fatal("Could not pick up CD, bailing out")
     display.msg("ERR DISK PICKUP")
+    finish(dest_tray)
     sys.exit(1)
 
-arm.pump(True)
-time.sleep(config.t_grab)
-
-display.msg("MOVE TO DST TRAY")
-
-arm.move_abs(config.drive_tray_pos)
-arm.wait_for_move_end()
-
-arm.move_abs(dest_tray)
-arm.wait_for_move_end()
-
-arm.pump(False)
-time.sleep(config.t_release)
-
-drive.close_tray()
-
-arm.origin()
+if cover is not None and not handler.wait_cover(cover) and dest_tray != 'error':
+    # The disc is in the DONE tray already, the capture still failed
+    log.error("Cover image of the disc put to DONE tray could not be written")
+    dest_tray = 'error'
 
+finish(dest_tray)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+
+#
+# The trays hold stacks of discs. The model keeps track of the expected height
+# of the top disc in each of the trays so that the arm doesn't need to descend
+# all the way from the tray position to find the disc or drop it from there.
+#
+# For the trays the discs are picked up from the height is learned from the
+# contact point reported by the arm. For the trays the discs are dropped onto
+# it is calculated from the tray floor height and the number of discs dropped.
+#
+# The model is persistent because the stacks outlive brain restarts. After
+# the done or error tray is emptied its stack needs to be reset with:
+#
+#   stacks.py reset done
+#
+class StackModel:
+    def __init__(self, config, filename=None):
+        self.config = config
+        self.filename = filename or config.stack_model_filename
+        self.log = logging.getLogger(__name__)
+
+        self.stacks = dict()
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as f:
+                    self.stacks = json.load(f)
+            except ValueError as e:
+                self.log.error("Could not load stack model from '{}': {}".format(self.filename, e))
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.stacks, f)
+        os.rename(tmp_filename, self.filename)
+
+    def stack(self, tray):
+        return self.stacks.setdefault(tray, { 'top': None, 'count': 0 })
+
+    # The expected height of the top disc in the tray, None if unknown
+    def top(self, tray):
+        return self.stack(tray)['top']
+
+    # A disc was picked up from the tray with the arm touching it at 'contact_z'
+    def picked(self, tray, contact_z):
+        stack = self.stack(tray)
+        stack['top'] = contact_z - self.config.disc_thickness
+        stack['count'] = max(stack['count'] - 1, 0)
+        self.save()
+
+    # Nothing was found in the tray
+    def empty(self, tray):
+        self.reset(tray)
+
+    # A disc was dropped onto the stack in the tray
+    def dropped(self, tray):
+        stack = self.stack(tray)
+        stack['count'] += 1
+
+        floor_z = self.config.tray_floor_z.get(tray)
+        if floor_z is not None:
+            stack['top'] = floor_z + stack['count'] * self.config.disc_thickness
+        self.save()
+
+    def reset(self, tray):
+        self.stacks[tray] = { 'top': None, 'count': 0 }
+        self.save()
+
+    # The position from which a disc should be dropped onto the tray at 'pos'
+    def drop_pos(self, tray, pos):
+        floor_z = self.config.tray_floor_z.get(tray)
+        if floor_z is None:
+            return pos
+
+        z = floor_z + (self.stack(tray)['count'] + 1) * self.config.disc_thickness + self.config.drop_clearance
+        return (pos[0], pos[1], min(pos[2], z))
+
+def main():
+
+    import argparse
+    import config
+
+    parser = argparse.ArgumentParser(description="Show or reset the tray stack model")
+    parser.add_argument("command", choices=['show', 'reset'])
+    parser.add_argument("trays", nargs='*', help="Trays to reset (all if none given)")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    stacks = StackModel(config)
+
+    if args.command == 'show':
+        for tray, stack in sorted(stacks.stacks.items()):
+            print("{}\ttop={}\tcount={}".format(tray, stack['top'], stack['count']))
+    elif args.command == 'reset':
+        for tray in (args.trays or list(stacks.stacks.keys())):
+            stacks.reset(tray)
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,10 @@ class Storage:
             return None
 
     def detect(self):
+        if self.config.storage_path is not None:
+            self.path = self.config.storage_path
+            return True
+
         proc = subprocess.run("lsblk -lpn --output LABEL,NAME | grep -F -- {}".format(self.config.storage_fs_label), shell=True, check=True, stdout=subprocess.PIPE)
         self.device = proc.stdout.decode('ascii').rstrip().split()[1]
 
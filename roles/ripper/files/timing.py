@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+#
+# Records how long the stages of the work take. Each span has a name, the wall clock
+# start time and the duration measured with the monotonic clock. Objects which can be
+# timed have a 'timings' attribute which defaults to null_timings, the spans are only
+# kept when the caller sets a Timings object there.
+#
+#   with timings.span('hough'):
+#       circles = cv2.HoughCircles(...)
+#
+class Timings:
+    def __init__(self):
+        self.spans = []
+
+    def add(self, name, start, duration, **attrs):
+        span = { 'name': name, 'start': start, 'duration': duration }
+        span.update(attrs)
+        self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        start = time.time()
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic() - t0, **attrs)
+
+    def merge(self, spans):
+        self.spans.extend(spans)
+
+    # Read the stages recorded by a script, each line holds the stage name and
+    # its start and end time in seconds since the epoch
+    def load(self, filename):
+        try:
+            with open(filename, 'r') as f:
+                for line in f:
+                    (name, start, end) = line.split()
+                    self.add(name, float(start), float(end) - float(start))
+        except (OSError, ValueError):
+            pass
+
+    def clear(self):
+        self.spans = []
+
+    # The total duration and number of spans by name
+    def summary(self):
+        summary = dict()
+        for span in self.spans:
+            (total, count) = summary.get(span['name'], (0, 0))
+            summary[span['name']] = (total + span['duration'], count + 1)
+        return summary
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({ 'spans': self.spans }, f, indent=1)
+
+class NullTimings(Timings):
+    def add(self, name, start, duration, **attrs):
+        pass
+
+    def merge(self, spans):
+        pass
+
+null_timings = NullTimings()
+
+#
+# The stage timings of all captures exported as a Prometheus text file, to be picked
+# up by the node exporter textfile collector. The totals are kept in a JSON state file
+# so that they survive brain restarts and can be updated from the ripper.py processes.
+#
+class Metrics:
+    def __init__(self, config):
+        self.config = config
+        self.log = logging.getLogger(__name__)
+
+    def load(self):
+        try:
+            with open(self.config.metrics_state_filename, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return { 'captures': dict(), 'stages': dict(), 'last': dict() }
+
+    def save(self, state):
+        tmp_filename = self.config.metrics_state_filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_filename, self.config.metrics_state_filename)
+
+    def add_capture(self, timings, result):
+        if self.config.metrics_textfile is None:
+            return
+
+        state = self.load()
+        state['captures'][result] = state['captures'].get(result, 0) + 1
+
+        summary = timings.summary()
+        for (name, (total, count)) in summary.items():
+            (stage_total, stage_count) = state['stages'].get(name, (0, 0))
+            state['stages'][name] = (stage_total + total, stage_count + count)
+        state['last'] = dict( (name, total) for (name, (total, count)) in summary.items() )
+
+        try:
+            self.save(state)
+            self.write(state)
+        except OSError as e:
+            self.log.warn("Could not write metrics to '{}': {}".format(self.config.metrics_textfile, e))
+
+    def write(self, state):
+        lines = [
+            "# HELP fred_captures_total Number of captures by result.",
+            "# TYPE fred_captures_total counter",
+        ]
+        for (result, count) in sorted(state['captures'].items()):
+            lines.append('fred_captures_total{{result="{}"}} {}'.format(result, count))
+
+        lines += [
+            "# HELP fred_stage_seconds_total Time spent in each capture stage.",
+            "# TYPE fred_stage_seconds_total counter",
+        ]
+        for (name, (total, count)) in sorted(state['stages'].items()):
+            lines.append('fred_stage_seconds_total{{stage="{}"}} {:.3f}'.format(name, total))
+
+        lines += [
+            "# HELP fred_stage_runs_total Number of times each capture stage was run.",
+            "# TYPE fred_stage_runs_total counter",
+        ]
+        for (name, (total, count)) in sorted(state['stages'].items()):
+            lines.append('fred_stage_runs_total{{stage="{}"}} {}'.format(name, count))
+
+        lines += [
+            "# HELP fred_last_capture_stage_seconds Time spent in each stage by the last capture.",
+            "# TYPE fred_last_capture_stage_seconds gauge",
+        ]
+        for (name, total) in sorted(state['last'].items()):
+            lines.append('fred_last_capture_stage_seconds{{stage="{}"}} {:.3f}'.format(name, total))
+
+        # The collector must never see a partially written file
+        tmp_filename = self.config.metrics_textfile + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmp_filename, self.config.metrics_textfile)
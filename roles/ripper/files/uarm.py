@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
 import logging
+import math
 import re
+import threading
 import time
+from concurrent.futures import Future, TimeoutError
+from timing import null_timings
+
+def dist(a,b):
+    return math.sqrt( (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2 )
 
 class UArm:
     default_speed = 100
@@ -15,24 +22,70 @@ class UArm:
 
         self.cmd_id = 1
         self.max_running_cmds = 100
+
+        # Asynchronous command mode, see start_async()
+        self.reader = None
+        self.pending = dict()
+        self.cmd_lock = threading.Lock()
+        self.inflight = threading.BoundedSemaphore(min(config.max_inflight_cmds, self.max_running_cmds - 1))
+        self.event_handlers = []
         #
         # Robot configuration
         #
         # Delay for 200 ms between queries
         self.move_wait_query_delay = 0.2
         # Time out after 60 seconds
-        self.move_wait_max_tries = int(60 / self.move_wait_query_delay)
+        self.move_wait_timeout = 60
+
+        #
+        # Move completion tracking, see wait_for_move_end()
+        #
+        # The last commanded position, None if unknown
+        self.target = None
+        # The time when the last queued move should end, None if unknown
+        self.move_end = None
+        self.move_start = None
+        self.move_predicted = None
+        self.move_pending = False
+        # The ratio between the actual and predicted move durations learned from past moves
+        self.move_correction = 1.0
+        # The number of moves for which a move end event was not yet received
+        self.moves_pending = 0
+        self.move_done = threading.Event()
+        self.move_events = False
+        self.event_handlers.append(self.handle_move_event)
+
+        # The heights at which the objects were picked up, indexed by the XY position
+        self.contact_heights = dict()
+        self.last_contact_z = None
+
+        self.timings = null_timings
 
     def connect(self):
         if self.wait_for_ready():
-            self.probe()
-            self.origin()
+            self.setup()
             return True
         else:
             self.log.fatal("Uarm is not ready")
         return False
 
+    # Prepare the arm for work after it has signalled READY
+    def setup(self):
+        if self.config.uarm_async_commands:
+            self.start_async()
+            if self.config.uarm_move_end_report_cmd:
+                resp = self.exec_cmd(self.config.uarm_move_end_report_cmd)
+                if ' OK' in resp:
+                    self.move_events = True
+                else:
+                    self.log.warn("Move end reports are not supported by firmware, got '{}'".format(resp))
+        self.probe()
+        self.origin()
+
     def exec_cmd(self, cmd):
+        if self.reader is not None:
+            return self.wait_response(self.exec_cmd_async(cmd))
+
         cmdstring = '#{} {}'.format(self.cmd_id, cmd)
         self.log.debug("Executing command '{}'".format(cmdstring))
 
@@ -44,6 +97,104 @@ class UArm:
         self.log.debug("Received response '{}'".format(resp))
         return resp
 
+    #
+    # In the asynchronous mode a reader thread matches responses to commands using
+    # the '#<id>' sent with the command and the '$<id>' in the response. This allows
+    # keeping up to 'max_inflight_cmds' commands in flight instead of waiting
+    # for a full serial round-trip after each of them.
+    #
+    def start_async(self):
+        self.reader = threading.Thread(target=self.read_responses, name="uarm-reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_responses(self):
+        try:
+            while True:
+                resp = self.comm.readline().decode('ascii').rstrip()
+                if not resp:
+                    continue
+
+                self.log.debug("Received response '{}'".format(resp))
+
+                if resp.startswith('$'):
+                    try:
+                        cmd_id = int(resp[1:].split(' ')[0])
+                    except ValueError:
+                        self.log.warn("Received garbled response '{}'".format(resp))
+                        continue
+                    # The future is completed under the lock, wait_response() cancels it
+                    # under the same lock when the response comes too late
+                    with self.cmd_lock:
+                        future = self.pending.pop(cmd_id, None)
+                        answered = future is not None and not future.done()
+                        if answered:
+                            future.set_result(resp)
+                    if not answered:
+                        self.log.warn("Received response '{}' for an unknown command".format(resp))
+                elif resp.startswith('@'):
+                    for handler in self.event_handlers:
+                        handler(resp)
+                else:
+                    self.log.warn("Unexpected line received from Uarm: '{}'".format(resp))
+        except Exception as e:
+            self.log.error("Uarm reader failed: {}".format(e))
+            with self.cmd_lock:
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(e)
+                self.pending.clear()
+                self.reader = None
+
+    # Send a command without waiting for the response, returns a Future with the response
+    def exec_cmd_async(self, cmd):
+        self.inflight.acquire()
+
+        future = Future()
+        future.add_done_callback(lambda f: self.inflight.release())
+
+        with self.cmd_lock:
+            cmdstring = '#{} {}'.format(self.cmd_id, cmd)
+            self.log.debug("Executing command '{}'".format(cmdstring))
+
+            # A command which never got its response is forgotten when its id is reused
+            orphan = self.pending.get(self.cmd_id)
+            if orphan is not None:
+                self.log.warn("Command id {} is reused before its response was received".format(self.cmd_id))
+                orphan.cancel()
+
+            future.cmd_id = self.cmd_id
+            self.pending[self.cmd_id] = future
+            self.cmd_id = (self.cmd_id + 1) % self.max_running_cmds
+
+            self.comm.write((cmdstring + "\n").encode('ascii'))
+
+        return future
+
+    # Execute a sequence of commands, in the asynchronous mode they are sent back-to-back
+    def exec_cmds(self, cmds):
+        if self.reader is None:
+            return [ self.exec_cmd(cmd) for cmd in cmds ]
+
+        futures = [ self.exec_cmd_async(cmd) for cmd in cmds ]
+        return [ self.wait_response(future) for future in futures ]
+
+    # Wait for the response to an asynchronous command. Like in the synchronous mode an empty
+    # response is returned when none is received in time, the command is then forgotten so
+    # that it doesn't hold its in-flight slot.
+    def wait_response(self, future):
+        try:
+            return future.result(timeout=self.config.serial_port_timeout)
+        except TimeoutError:
+            with self.cmd_lock:
+                if self.pending.get(future.cmd_id) is future:
+                    del self.pending[future.cmd_id]
+                # The response may have arrived in the meantime
+                if not future.cancel():
+                    return future.result()
+            self.log.warn("No response received for command id {}".format(future.cmd_id))
+            return ''
+
     # Wait for the Uarm to send a "READY" token
     def wait_for_ready(self):
         resp = self.comm.readline().decode('ascii').rstrip()
@@ -72,11 +223,9 @@ class UArm:
         #1 G0 X0 Y150 Z100 F0
         #1 G202 N3 V90.0
         #1 G0 X0 Y150 Z100 F0
-        self.pump(False)
-        self.grip(False)
-        self.move_abs((0, 150, 100), 0)
-        self.servo_abs(3, 90)
-        self.move_abs((0, 150, 100), 0)
+        self.expect_move((0, 150, 100), 0)
+        self.expect_move((0, 150, 100), 0)
+        self.exec_cmds([ "M231 V0", "M232 V0", "G0 X0 Y150 Z100 F0", "G202 N3 V90", "G0 X0 Y150 Z100 F0" ])
 
     def robot_moving(self):
         resp = self.exec_cmd("M200")
@@ -89,20 +238,119 @@ class UArm:
             self.log.error("Unknown response for move check command: '{}'".format(resp))
             return '?'
 
+    #
+    # Moves are queued by the firmware, so the predicted end of a move is counted from
+    # the predicted end of the previous one. The duration is estimated from the distance
+    # and the F speed and corrected using the durations observed for the previous moves.
+    #
+    def expect_move(self, p, speed):
+        now = time.monotonic()
+
+        if self.target is None or (self.move_pending and self.move_end is None):
+            # The start position or the end of the previous move is unknown
+            self.move_start = now
+            self.move_predicted = None
+            self.move_end = None
+        else:
+            if self.move_end is None or self.move_end < now:
+                self.move_start = now
+            else:
+                self.move_start = self.move_end
+
+            if speed == 0:
+                v = self.config.move_max_speed
+            else:
+                v = min(speed * self.config.move_speed_scale, self.config.move_max_speed)
+
+            self.move_predicted = dist(self.target, p) / v + self.config.move_settle_time
+            self.move_end = self.move_start + self.move_predicted * self.move_correction
+
+        # Not all firmware reports the end of a move to where the arm already is
+        if self.move_events and self.target != tuple(p):
+            self.moves_pending += 1
+            self.move_done.clear()
+
+        self.target = tuple(p)
+        self.move_pending = True
+
+    def handle_move_event(self, event):
+        if not self.move_events or not event.startswith(self.config.uarm_move_end_event):
+            return
+
+        self.moves_pending = max(self.moves_pending - 1, 0)
+        if self.moves_pending == 0:
+            self.move_done.set()
+
+    def learn_move_duration(self, overslept):
+        if self.move_predicted is None or self.move_predicted == 0:
+            return
+
+        if overslept:
+            # The move has ended before the first check, so the actual duration is unknown
+            self.move_correction *= 0.8
+        else:
+            ratio = (time.monotonic() - self.move_start) / self.move_predicted
+            self.move_correction = 0.7 * self.move_correction + 0.3 * ratio
+
+        self.move_correction = min(max(self.move_correction, 0.1), 10.0)
+
     def wait_for_move_end(self):
-        for i in range(self.move_wait_max_tries):
+        with self.timings.span('move'):
+            self.wait_move()
+
+    def wait_move(self):
+        start = time.monotonic()
+        slept = False
+
+        if self.move_end is not None:
+            # Sleep until just before the predicted end of the move
+            delay = self.move_end - start - self.config.move_wait_fast_window / 2
+            if self.move_events:
+                if self.move_done.wait(timeout=max(delay, 0) + self.config.move_wait_fast_window):
+                    self.move_end = None
+                    self.move_pending = False
+                    return
+                self.log.debug("Move end event was not received in time, polling")
+            elif delay > 0:
+                time.sleep(delay)
+                slept = True
+
+        # Poll quickly around the predicted end of the move, then fall back to the usual delay
+        fast_until = max(self.move_end or start, time.monotonic()) + self.config.move_wait_fast_window
+
+        first = True
+        while time.monotonic() - start < self.move_wait_timeout:
             if not self.robot_moving():
+                self.learn_move_duration(overslept=first and slept)
+                self.move_end = None
+                self.move_pending = False
+
+                # The move end events which were missed won't come anymore
+                self.moves_pending = 0
+                self.move_done.set()
                 return
-            time.sleep(self.move_wait_query_delay)
-        self.log.error("Timeout '{}' seconds while waiting for robot to stop moving".format(self.move_wait_max_tries * self.move_wait_query_delay))
+
+            first = False
+            if time.monotonic() < fast_until:
+                time.sleep(self.config.move_wait_fast_delay)
+            else:
+                time.sleep(self.move_wait_query_delay)
+
+        self.log.error("Timeout '{}' seconds while waiting for robot to stop moving".format(self.move_wait_timeout))
 
     def servo_abs(self, servo_id, angle):
         return self.exec_cmd("G202 N{} V{}".format(servo_id, angle))
 
     def move_abs(self, p, speed=default_speed):
+        self.expect_move(p, speed)
         return self.exec_cmd("G0 X{} Y{} Z{} F{}".format(p[0],p[1],p[2],speed))
 
     def move_rel(self, dp, speed=default_speed):
+        if self.target is None:
+            self.move_end = None
+            self.move_pending = True
+        else:
+            self.expect_move((self.target[0] + dp[0], self.target[1] + dp[1], self.target[2] + dp[2]), speed)
         return self.exec_cmd("G204 X{} Y{} Z{} F{}".format(dp[0],dp[1],dp[2],speed))
 
     def analogread(self, pin):
@@ -151,10 +399,37 @@ class UArm:
             self.log.error("Unknown response for switch state command: '{}'".format(resp))
             return '?'
 
-    def pickup_object(self, p, z_min):
+    #
+    # Lower the arm at 'p' until the limit switch detects contact with the object or 'z_min'
+    # is reached. The arm moves in one go to 'pickup_fine_range' above the expected contact
+    # height (given in 'z_hint' or learned from the previous pickup at the same spot) and
+    # descends in 'grab_step' steps only from there.
+    #
+    def pickup_object(self, p, z_min, z_hint=None):
         limit_switch = False
-        self.move_abs(p)
-        self.wait_for_move_end()
+        key = (p[0], p[1])
+
+        if z_hint is None:
+            z_hint = self.contact_heights.get(key)
+
+        if self.target != tuple(p):
+            self.move_abs(p)
+
+        if z_hint is not None and z_hint + self.config.pickup_fine_range < p[2]:
+            approach = (p[0], p[1], max(z_hint + self.config.pickup_fine_range, z_min))
+            self.move_abs(approach)
+            self.wait_for_move_end()
+
+            if not self.switch_state():
+                # The object is higher than expected, start over from the top
+                self.log.warn("Contact at approach height '{}', expected at '{}'".format(approach[2], z_hint))
+                self.contact_heights.pop(key, None)
+                self.move_abs(p)
+                self.wait_for_move_end()
+            else:
+                p = approach
+        else:
+            self.wait_for_move_end()
 
         while p[2] > z_min:
             p = (p[0], p[1], p[2] - self.config.grab_step)
@@ -163,15 +438,46 @@ class UArm:
 
             if not self.switch_state():
                 limit_switch = True
+                self.contact_heights[key] = p[2]
+                self.last_contact_z = p[2]
                 return True
 
         if not limit_switch:
             self.log.error("Reached z min '{}' but item was not detected".format(z_min))
+            self.contact_heights.pop(key, None)
             return False
 
-        self.log.fatal("An unforseen state has been detected, reached position '{}' with z_min '{}' and switch state '{}'".format(pz, z_min, limit_switch))
+        self.log.fatal("An unforseen state has been detected, reached position '{}' with z_min '{}' and switch state '{}'".format(p, z_min, limit_switch))
         return None
 
+    # The height at which the arm touched the object during the last successful pickup
+    def contact_z(self):
+        return self.last_contact_z
+
+    # Check if a disc is present in the source tray using the reflective IR sensor
+    # (see the disc presence sensor description in config.py)
+    def disc_present(self):
+        # Switch off LED
+        self.digitalout(self.config.led_drive_pin, False)
+        led_off = self.analogread(self.config.sensor_voltage_pin)
+
+        time.sleep(self.config.sensor_delay)
+
+        # Switch on LED
+        self.digitalout(self.config.led_drive_pin, True)
+        led_on = self.analogread(self.config.sensor_voltage_pin)
+
+        signal = led_on - led_off
+
+        self.log.debug("A{} readout led on D{} off '{}' led on '{}' signal '{}'".format(self.config.sensor_voltage_pin, self.config.led_drive_pin,
+                                                                                        led_off, led_on, signal))
+
+        if signal > self.config.detect_threshold:
+            self.log.info("Disc detected in source tray (signal value is '{}')".format(signal))
+            return True
+
+        return False
+
 def main():
 
     import config
@@ -198,23 +504,7 @@ def main():
     # Wait for a disc to be detected in the source tray
     #
     while True:
-        # Switch off LED
-        arm.digitalout(config.led_drive_pin, False)
-        led_off = arm.analogread(config.sensor_voltage_pin)
-
-        time.sleep(config.sensor_delay)
-
-        # Switch on LED
-        arm.digitalout(config.led_drive_pin, True)
-        led_on = arm.analogread(config.sensor_voltage_pin)
-
-        signal = led_on - led_off
-
-        log.debug("A{} readout led on D{} off '{}' led on '{}' signal '{}'".format(config.sensor_voltage_pin, config.led_drive_pin,
-                                                                                   led_off, led_on, signal))
-
-        if signal > config.detect_threshold:
-            log.info("Disc detected in source tray (signal value is '{}')".format(signal))
+        if arm.disc_present():
             break
 
         time.sleep(config.sensor_delay)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+#
+# Replays stored camera images through the vision pipeline without the robot.
+#
+# The images named 'calibration-*.jpg' (as kept by the brain when calibration fails) are
+# run through marker detection, all other images through the cover image pipeline. The
+# calibration markers for the covers are taken from the --calibration file (in the format
+# of /run/fred/calibration_data.json, either for one drive or by drive device) or detected
+# on the first calibration image.
+#
+# The time spent in each stage, the peak RSS and the results (marker positions, disc
+# circles and a checksum of the cover images) are reported. With --baseline they are
+# compared to a report saved earlier with --save, the exit status is 1 when the results
+# differ or a stage got slower by more than --tolerance.
+#
+#   vision-bench.py --calibration calibration_data.json --save baseline.json images/
+#   (upgrade OpenCV or change the parameters)
+#   vision-bench.py --calibration calibration_data.json --baseline baseline.json images/
+#
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+from vision import Vision, marker_positions
+from timing import Timings
+
+import config
+
+parser = argparse.ArgumentParser(description="Benchmark the vision pipeline on stored images")
+parser.add_argument("images", help="Directory with the calibration and cover images")
+parser.add_argument("--calibration", help="Calibration markers file")
+parser.add_argument("--device", help="Drive device to take the calibration markers for")
+parser.add_argument("--repeat", type=int, default=3, help="Number of times each image is processed")
+parser.add_argument("--output-dir", dest="output_dir", help="Directory where the cover images are written")
+parser.add_argument("--baseline", help="Compare to the report saved in this file")
+parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown of a stage")
+parser.add_argument("--save", help="Save the report to this file")
+
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARN)
+log = logging.getLogger(__name__)
+
+vision = Vision(config)
+vision.timings = Timings()
+
+output_dir = args.output_dir or tempfile.mkdtemp(prefix="vision-bench-")
+
+filenames = sorted(f for f in os.listdir(args.images) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+calibration_images = [ f for f in filenames if f.startswith('calibration') ]
+cover_images = [ f for f in filenames if not f.startswith('calibration') ]
+
+def round_pos(pos):
+    return [ round(v, 1) for v in pos ]
+
+calibration_markers = None
+if args.calibration:
+    with open(args.calibration, 'r') as f:
+        calibration_markers = json.load(f)
+    if 'disk_center' not in calibration_markers:
+        calibration_markers = calibration_markers[args.device] if args.device else list(calibration_markers.values())[0]
+
+# The stage durations of all runs by stage name and the results by image
+durations = dict()
+results = dict()
+
+def record_run():
+    for (name, (total, count)) in vision.timings.summary().items():
+        durations.setdefault(name, []).append(total)
+    vision.timings.clear()
+
+for filename in calibration_images:
+    with open(os.path.join(args.images, filename), 'rb') as f:
+        image = f.read()
+
+    for i in range(args.repeat):
+        (markers, frame) = vision.detect_markers(image)
+        record_run()
+
+    positions = marker_positions(markers) if markers else dict()
+    results[filename] = dict( (name, round_pos(pos)) for (name, pos) in positions.items() )
+
+    if calibration_markers is None and 'disk_center' in positions and 'disk_edge' in positions:
+        calibration_markers = positions
+
+if cover_images and calibration_markers is None:
+    log.error("No calibration markers given or detected, cannot process the cover images")
+    sys.exit(2)
+
+for filename in cover_images:
+    with open(os.path.join(args.images, filename), 'rb') as f:
+        image = f.read()
+
+    cover_filename = os.path.join(output_dir, os.path.splitext(filename)[0] + "-cover.png")
+    for i in range(args.repeat):
+        (p, r) = vision.write_cover_image(image, cover_filename, calibration_markers)
+        record_run()
+
+    # The PNG encoding is deterministic for the same pixels and encoder settings
+    with open(cover_filename, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    results[filename] = { 'p': [ int(p[0]), int(p[1]) ], 'r': int(r), 'sha1': digest }
+
+report = {
+    'images': len(calibration_images) + len(cover_images),
+    'repeat': args.repeat,
+    'stages': dict( (name, statistics.median(values)) for (name, values) in durations.items() ),
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'results': results,
+}
+
+print("{:<12} {:>6} {:>10} {:>10} {:>10}".format("stage", "runs", "median ms", "mean ms", "max ms"))
+for (name, values) in sorted(durations.items(), key=lambda item: -sum(item[1])):
+    print("{:<12} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format(name, len(values), statistics.median(values) * 1000,
+                                                             statistics.mean(values) * 1000, max(values) * 1000))
+print("peak RSS {} kB, {} images, cover images in '{}'".format(report['peak_rss_kb'], report['images'], output_dir))
+
+if args.save:
+    with open(args.save, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+failed = False
+
+if args.baseline:
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+
+    for (name, median) in sorted(report['stages'].items()):
+        base = baseline['stages'].get(name)
+        if base is None:
+            print("stage '{}' is not in the baseline".format(name))
+        elif median > base * (1 + args.tolerance):
+            print("stage '{}' got slower: {:.1f} ms -> {:.1f} ms".format(name, base * 1000, median * 1000))
+            failed = True
+        else:
+            print("stage '{}': {:.1f} ms -> {:.1f} ms".format(name, base * 1000, median * 1000))
+
+    print("peak RSS: {} kB -> {} kB".format(baseline['peak_rss_kb'], report['peak_rss_kb']))
+
+    for (filename, result) in sorted(report['results'].items()):
+        base = baseline['results'].get(filename)
+        if base is not None and base != result:
+            print("result for '{}' changed: {} -> {}".format(filename, base, result))
+            failed = True
+
+sys.exit(1 if failed else 0)
@@ -8,6 +8,18 @@ import math
 import cv2.aruco as aruco
 import tempfile
 import subprocess
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from camera import ChdkSession
+from timing import Timings, null_timings
+
+# A detected marker, the corners are a (4, 2) array and the pose is a (rvec, tvec) pair
+# if the camera matrix is configured
+Marker = namedtuple('Marker', [ 'id', 'center', 'corners', 'pose' ])
+
+# The marker centers by name as stored in the calibration data
+def marker_positions(markers):
+    return dict( (name, list(marker.center)) for (name, marker) in markers.items() )
 
 def dist(a,b):
     return math.sqrt( (a[0] - b[0]) * (a[0] - b[0]) + (a[1] - b[1]) * (a[1] - b[1]) )
@@ -18,6 +30,9 @@ class Vision:
         self.aruco_dict = aruco.Dictionary_get(self.config.aruco_dict)
         self.parameters = aruco.DetectorParameters_create()
         self.log = logging.getLogger(__name__)
+        self.camera = None
+        self.buffers = dict()
+        self.timings = null_timings
 
     def image_acquire(self, filename=tempfile.mktemp()):
 
@@ -34,15 +49,73 @@ class Vision:
             self.log.warn("Could not acquire image to file '{}'".format(filename))
             return None
 
-    def detect_markers(self, image_filename):
-        self.log.info("Searching for markers in '{}'".format(image_filename))
+    # Take a photo and return it as an encoded JPEG buffer. With 'camera_session' enabled
+    # the photo is taken using a persistent chdkptp session instead of shoot-photo.sh.
+    def image_capture(self):
+        with self.timings.span('photo'):
+            return self.take_photo()
+
+    def take_photo(self):
+        if self.config.camera_session:
+            if self.camera is None:
+                self.camera = ChdkSession(self.config)
+
+            data = self.camera.shoot()
+            if data is not None:
+                self.log.info("Acquired image ({} bytes)".format(len(data)))
+            return data
+
+        filename = self.image_acquire(tempfile.mktemp(dir=self.config.camera_spool_dir))
+        if not filename:
+            return None
+
+        with open(filename, 'rb') as f:
+            data = f.read()
+        os.unlink(filename)
+
+        return data
+
+    # Release the camera so that other processes can use it
+    def close(self):
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+
+    # The images can be given as a filename, an encoded image buffer or a decoded image
+    def load_image(self, image, flags=cv2.IMREAD_COLOR):
+        if isinstance(image, np.ndarray):
+            return image
+        elif isinstance(image, (bytes, bytearray)):
+            return cv2.imdecode(np.frombuffer(image, np.uint8), flags)
+        else:
+            return cv2.imread(image, flags)
+
+    def image_name(self, image):
+        if isinstance(image, str):
+            return image
+        elif isinstance(image, (bytes, bytearray)):
+            return "<{} byte buffer>".format(len(image))
+        else:
+            return "<image>"
+
+    # The 'marker_ids' dictionary maps the returned marker names to ARuCO marker ids,
+    # by default the disk center and edge markers from config are used. The markers are
+    # returned as Marker tuples with sub-pixel centers, see marker_positions().
+    def detect_markers(self, image, marker_ids=None):
+        self.log.info("Searching for markers in '{}'".format(self.image_name(image)))
+
+        if marker_ids is None:
+            marker_ids = { 'disk_center': self.config.center_marker_id, 'disk_edge': self.config.edge_marker_id }
 
-        frame = cv2.imread(image_filename)
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        with self.timings.span('decode'):
+            frame = self.load_image(image)
 
-        #lists of ids and the corners beloning to each id
-        markers, ids, rejectedImgPoints = aruco.detectMarkers(gray, self.aruco_dict, parameters=self.parameters)
-        if markers is None or ids is None:
+        with self.timings.span('markers'):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+            #lists of ids and the corners beloning to each id
+            markers, ids, rejectedImgPoints = aruco.detectMarkers(gray, self.aruco_dict, parameters=self.parameters)
+        if markers is None or ids is None or len(ids) == 0:
             self.log.warn("Could not detect any markers, make sure that the camera is setup in a correct way")
             return (None, frame)
 
@@ -53,107 +126,209 @@ class Vision:
         self.log.debug(ids)
         self.log.debug(rejectedImgPoints)
 
-        interesting_markers = dict()
+        # All of the marker corners as a (n, 4, 2) array
+        corners = np.concatenate(markers).reshape(-1, 4, 2)
+        centers = corners.mean(axis=1)
+        ids = ids.flatten()
 
-        for i in range(len(markers)):
-            marker_corners = markers[i][0]
-            marker_id = ids[i][0]
-            marker_name = None
-
-            xsum = ysum = 0
-            for corner in marker_corners:
-                xsum = xsum + int(corner[0])
-                ysum = ysum + int(corner[1])
-                if self.log.isEnabledFor(logging.DEBUG):
-                    self.log.debug("Marker ID '{}' Corner = '{}'".format(marker_id, corner))
-                    cv2.circle(frame, (corner[0], corner[1]), 20, (0,255,0), -1)
-
-                marker_center = (xsum//4, ysum//4)
-                if self.log.isEnabledFor(logging.DEBUG):
-                    cv2.circle(frame, marker_center, 20, (255,255,255), -1)
-
-            if marker_id == self.config.center_marker_id:
-                marker_name = "disk_center"
-            elif marker_id == self.config.edge_marker_id:
-                marker_name = "disk_edge"
-            else:
-                pass
-
-            if marker_name:
-                interesting_markers[marker_name] = marker_center
+        poses = [ None ] * len(ids)
+        if self.config.camera_matrix is not None:
+            rvecs, tvecs, _ = aruco.estimatePoseSingleMarkers(markers, self.config.marker_size,
+                                                              np.array(self.config.camera_matrix, np.float64),
+                                                              np.array(self.config.camera_distortion, np.float64))
+            poses = [ (rvecs[i][0], tvecs[i][0]) for i in range(len(ids)) ]
 
-            if self.log.isEnabledFor(logging.DEBUG):
-                for rejected_marker in rejectedImgPoints:
-                    for corner in rejected_marker[0]:
-                        cv2.circle(frame, (corner[0], corner[1]), 5, (255,0,0), -1)
+        names = dict( (id, name) for (name, id) in marker_ids.items() )
 
+        interesting_markers = dict()
+        for i in range(len(ids)):
+            name = names.get(ids[i])
+            if name is not None:
+                interesting_markers[name] = Marker(int(ids[i]), (float(centers[i][0]), float(centers[i][1])), corners[i], poses[i])
 
-            if self.log.isEnabledFor(logging.DEBUG):
-                frame = aruco.drawDetectedMarkers(frame, markers, ids)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Marker centers: {}".format(dict(zip(ids.tolist(), centers.tolist()))))
+
+            frame = aruco.drawDetectedMarkers(frame, markers, ids.reshape(-1, 1))
+            if len(rejectedImgPoints) > 0:
+                frame = aruco.drawDetectedMarkers(frame, rejectedImgPoints, borderColor=(255,0,0))
+            for center in np.around(centers).astype(np.int32):
+                cv2.circle(frame, tuple(center.tolist()), 20, (255,255,255), -1)
 
         return (interesting_markers, frame)
 
-    def write_cover_image(self, image_filename, cover_filename, calibration_markers):
+    # Find the disc circle close to the calibrated one. The circle is searched for with the
+    # Hough transform only in the region around the calibrated circle and on a downscaled
+    # copy of it. The coarse circle is then refined by fitting a circle to the full
+    # resolution edge pixels lying in a narrow annulus around it.
+    def find_disc(self, img, disk_center, mask_r):
+        height = img.shape[0]
+        width = img.shape[1]
 
-        self.log.debug("Using calibration data: {}".format(calibration_markers))
+        roi_r = int(mask_r * 1.02) + self.config.cover_roi_margin
+        x0 = max(int(disk_center[0]) - roi_r, 0)
+        y0 = max(int(disk_center[1]) - roi_r, 0)
+        x1 = min(int(disk_center[0]) + roi_r, width)
+        y1 = min(int(disk_center[1]) + roi_r, height)
 
-        img = cv2.imread(image_filename, cv2.IMREAD_UNCHANGED)
+        scale = self.config.cover_detect_scale
 
-        height = img.shape[0]
-        width = img.shape[1]
+        with self.timings.span('downscale'):
+            roi = img[y0:y1, x0:x1]
+            gray = cv2.cvtColor(roi, cv2.COLOR_BGRA2GRAY if roi.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+            small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-        self.log.info("Loaded image from file '{}' (resolution {}x{}, {} channels)".format(image_filename, width, height, img.shape[2]) )
+        with self.timings.span('blur'):
+            blurred = cv2.medianBlur(small, 5)
 
-        if img.shape[2] != 4:
-            self.log.warn("File '{}' doesn't have an alhpa channel, adding".format(image_filename))
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
+        with self.timings.span('canny'):
+            edges = cv2.Canny(blurred, 100, 200)
 
-        disk_center = tuple(calibration_markers['disk_center'])
-        disk_edge = tuple(calibration_markers['disk_edge'])
-        mask_r = int(math.sqrt( (disk_center[0]-disk_edge[0])**2 + (disk_center[1]-disk_edge[1])**2 )) + self.config.mask_r_fix
+        if self.log.isEnabledFor(logging.DEBUG):
+            cv2.imwrite('src-image-edges.jpg', edges)
+
+        # The circle perimeter and so the number of votes shrinks with the image
+        with self.timings.span('hough'):
+            circles = cv2.HoughCircles(edges, cv2.HOUGH_GRADIENT, 1, 20, param1=50, param2=max(int(30 * scale), 10),
+                                       minRadius=int(mask_r * 0.98 * scale), maxRadius=int(math.ceil(mask_r * 1.02 * scale)))
 
-        p = disk_center
+        p = (int(round(disk_center[0])), int(round(disk_center[1])))
         r = mask_r
 
-        hole_r = int(r * self.config.mask_hole_ratio)
-        self.log.info("Calculated from calibration data: radius {}px, hole radius {}px".format(r, hole_r))
+        if circles is None:
+            self.log.warn("No circles detected on image, using calibration data directly")
+            return (p, r)
 
-        if self.log.isEnabledFor(logging.DEBUG):
-            cv2.circle(img, disk_center, 5, (255.0,0), -1)
-            cv2.circle(img, disk_edge, 5, (255.0,0), -1)
+        self.log.info("Found {} circles on image".format(len(circles[0,:])))
 
-        edges = cv2.Canny(cv2.medianBlur(img, 5), 100, 200)
-        if self.log.isEnabledFor(logging.DEBUG):
-            cv2.imwrite('src-image-edges.jpg', edges)
+        min_d = 1000
 
-        circles = cv2.HoughCircles(edges, cv2.HOUGH_GRADIENT, 1, 20, param1=50, param2=30, minRadius=np.uint16(r*0.98), maxRadius=np.uint16(r*1.02))
+        for i in circles[0,:]:
+            c = (x0 + i[0] / scale, y0 + i[1] / scale)
+            cr = i[2] / scale
 
-        if circles is not None:
+            if self.log.isEnabledFor(logging.DEBUG):
+                cv2.circle(img, (int(c[0]), int(c[1])), int(cr), (255,255,255), 2)
 
-            circles = np.uint16(np.around(circles))
-            self.log.info("Found {} circles on image".format(len(circles[0,:])))
+            dp = dist(disk_center, c)
+            dr = abs(cr - mask_r)
 
-            min_d = 1000
+            if dp + dr < min_d:
+                p = c
+                r = cr
+                min_d = dp + dr
 
-            for i in circles[0,:]:
+        self.log.info("Best coarse circle p={} r={:.1f}".format(tuple(round(v, 1) for v in p), r))
 
-                if self.log.isEnabledFor(logging.DEBUG):
-                    cv2.circle(img, (i[0], i[1]), i[2], (255,255,255), 2)
+        with self.timings.span('refine'):
+            (p, r) = self.refine_circle(gray, (x0, y0), p, r)
+        self.log.info("Best circle p={} r={}".format(p, r))
 
-                dp = dist(disk_center, (i[0], i[1]))
-                dr = abs(i[2] - mask_r)
-                # self.log.debug("Circle pos {} r={}, dp={} dr={}, d={}".format((i[0], i[1]), i[2], dp, dr, dp + dr))
+        return (p, r)
 
-                if  dp + dr < min_d:
-                    p = (i[0], i[1])
-                    r = i[2]
-                    min_d = dp + dr
+    # Fit a circle to the edge pixels of the grayscale 'gray' image at 'offset' in the annulus
+    # 'cover_refine_band' pixels wide around the circle (p, r)
+    def refine_circle(self, gray, offset, p, r):
+        band = self.config.cover_refine_band
+        coarse = ((int(round(p[0])), int(round(p[1]))), int(round(r)))
 
-            self.log.info("Best circle p=%s r=%s" % (p, r))
+        # The box around the annulus in the 'gray' coordinates
+        bx0 = max(int(p[0] - offset[0] - r) - band, 0)
+        by0 = max(int(p[1] - offset[1] - r) - band, 0)
+        bx1 = min(int(p[0] - offset[0] + r) + band + 1, gray.shape[1])
+        by1 = min(int(p[1] - offset[1] + r) + band + 1, gray.shape[0])
 
+        edges = cv2.Canny(cv2.medianBlur(gray[by0:by1, bx0:bx1], 5), 100, 200)
 
-        else:
-            self.log.warn("No circles detected on image, using calibration data directly")
+        annulus = np.zeros_like(edges)
+        cv2.circle(annulus, (int(round(p[0] - offset[0] - bx0)), int(round(p[1] - offset[1] - by0))), int(round(r)), 255, 2 * band)
+        cv2.bitwise_and(edges, annulus, dst=edges)
+
+        (ys, xs) = np.nonzero(edges)
+        if len(xs) < self.config.cover_refine_min_points:
+            self.log.warn("Only {} edge points close to the disc circle, not refining it".format(len(xs)))
+            return coarse
+
+        # Least squares fit of x^2 + y^2 = a*x + b*y + c
+        xs = xs.astype(np.float64)
+        ys = ys.astype(np.float64)
+        A = np.column_stack((xs, ys, np.ones(len(xs))))
+        (a, b, c) = np.linalg.lstsq(A, xs * xs + ys * ys, rcond=None)[0]
+
+        cx = a / 2
+        cy = b / 2
+        fitted_r = math.sqrt(c + cx * cx + cy * cy)
+        fitted_p = (offset[0] + bx0 + cx, offset[1] + by0 + cy)
+
+        if dist(fitted_p, p) > band or abs(fitted_r - r) > band:
+            self.log.warn("Refined circle p={} r={:.1f} is too far from the coarse one, not using it".format(fitted_p, fitted_r))
+            return coarse
+
+        return ((int(round(fitted_p[0])), int(round(fitted_p[1]))), int(round(fitted_r)))
+
+    # Detect the markers only in the square regions 2*'roi_size' pixels wide around their
+    # 'expected' positions. Returns the positions of the markers which were found.
+    def detect_markers_near(self, image, expected, marker_ids, roi_size):
+        gray = self.load_image(image, cv2.IMREAD_GRAYSCALE)
+
+        height = gray.shape[0]
+        width = gray.shape[1]
+
+        found = dict()
+        for name, pos in expected.items():
+            x0 = max(int(pos[0]) - roi_size, 0)
+            y0 = max(int(pos[1]) - roi_size, 0)
+            x1 = min(int(pos[0]) + roi_size, width)
+            y1 = min(int(pos[1]) + roi_size, height)
+
+            markers, ids, rejectedImgPoints = aruco.detectMarkers(gray[y0:y1, x0:x1], self.aruco_dict, parameters=self.parameters)
+            if ids is None:
+                continue
+
+            for i in range(len(ids)):
+                if ids[i][0] == marker_ids[name]:
+                    center = markers[i][0].mean(axis=0)
+                    found[name] = (x0 + float(center[0]), y0 + float(center[1]))
+
+        return found
+
+    # Views of the buffers kept between discs, a buffer is only reallocated when a larger one is needed
+    def buffer(self, name, shape):
+        buf = self.buffers.get(name)
+        if buf is None or len(buf.shape) != len(shape) or any(b < s for (b, s) in zip(buf.shape, shape)):
+            if buf is not None and len(buf.shape) == len(shape):
+                shape = tuple(max(b, s) for (b, s) in zip(buf.shape, shape))
+            self.log.debug("Allocating '{}' buffer {}".format(name, shape))
+            buf = np.empty(shape, np.uint8)
+            self.buffers[name] = buf
+
+        return buf[tuple(slice(0, s) for s in shape)]
+
+    def write_cover_image(self, image, cover_filename, calibration_markers):
+
+        self.log.debug("Using calibration data: {}".format(calibration_markers))
+
+        image_filename = self.image_name(image)
+        with self.timings.span('decode'):
+            img = self.load_image(image)
+
+        height = img.shape[0]
+        width = img.shape[1]
+
+        self.log.info("Loaded image '{}' (resolution {}x{}, {} channels)".format(image_filename, width, height, img.shape[2]) )
+
+        disk_center = tuple(calibration_markers['disk_center'])
+        disk_edge = tuple(calibration_markers['disk_edge'])
+        mask_r = int(dist(disk_center, disk_edge)) + self.config.mask_r_fix
+
+        hole_r = int(mask_r * self.config.mask_hole_ratio)
+        self.log.info("Calculated from calibration data: radius {}px, hole radius {}px".format(mask_r, hole_r))
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            cv2.circle(img, (int(disk_center[0]), int(disk_center[1])), 5, (255.0,0), -1)
+            cv2.circle(img, (int(disk_edge[0]), int(disk_edge[1])), 5, (255.0,0), -1)
+
+        (p, r) = self.find_disc(img, disk_center, mask_r)
 
         # Enlarge the cover circle a bit to reduce cutting of small text on the edges
         r = int(r*1.05)
@@ -168,22 +343,74 @@ class Vision:
 
             cv2.imwrite("src-image-debug.jpg", img)
 
-        mask_img = np.zeros((height, width, 4), np.uint8)
+        # Only the 2r x 2r window around the disc is processed. The mask holds 1 for the
+        # pixels on the disc so that it can be used as a boolean array as well.
+        size = 2 * r
 
-        cv2.circle(mask_img, p, r, (255,255,255,255), -1)
-        cv2.circle(mask_img, p, hole_r, (0,0,0,0), -1)
+        # The part of the window which lies within the frame
+        x0 = max(p[0] - r, 0)
+        y0 = max(p[1] - r, 0)
+        x1 = min(p[0] + r, width)
+        y1 = min(p[1] + r, height)
+        if x0 != p[0] - r or y0 != p[1] - r or x1 != p[0] + r or y1 != p[1] + r:
+            self.log.warn("Disc circle p={} r={} extends beyond the image, the cover will be padded".format(p, r))
 
-        if self.log.isEnabledFor(logging.DEBUG):
-            cv2.imwrite("mask.png", mask_img)
+        with self.timings.span('mask'):
+            mask = self.buffer('mask', (size, size))
+            mask.fill(0)
+            cv2.circle(mask, (r, r), r, 1, -1)
+            cv2.circle(mask, (r, r), hole_r, 0, -1)
 
-        cd = cv2.bitwise_and(img, mask_img)
+            cd = self.buffer('cover', (size, size, 4))
+            cd.fill(0)
+
+            window = (slice(y0 - (p[1] - r), y1 - (p[1] - r)), slice(x0 - (p[0] - r), x1 - (p[0] - r)))
+            np.copyto(cd[window][:, :, :3], img[y0:y1, x0:x1], where=mask[window].view(np.bool_)[:, :, np.newaxis])
+            np.multiply(mask, 255, out=cd[:, :, 3])
 
         if self.log.isEnabledFor(logging.DEBUG):
-            cv2.imwrite("image-masked.png", cd)
+            cv2.imwrite("mask.png", mask * 255)
+
+        with self.timings.span('encode'):
+            cv2.imwrite(cover_filename, cd)
 
-        cd = cd[p[1] - r:p[1] + r, p[0] - r:p[0] + r]
+        return (p, r)
 
-        cv2.imwrite(cover_filename, cd)
+#
+# The cover images are rendered in worker processes so that the arm doesn't have to wait
+# for the image processing before it can take the disc out of the drive tray.
+#
+class CoverWorkers:
+    def __init__(self, config):
+        self.pool = ProcessPoolExecutor(max_workers=config.cover_workers)
+
+        # Start the worker processes right away, before the caller starts any threads,
+        # forking a process with other threads running can leave locks held in the child
+        self.pool.submit(int).result()
+
+    # Returns a future which completes with the stage timings when the cover image is written
+    def submit(self, image, cover_filename, calibration_markers):
+        return self.pool.submit(render_cover, image, cover_filename, calibration_markers)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+# The Vision object used by the cover worker process
+worker_vision = None
+
+def render_cover(image, cover_filename, calibration_markers):
+    global worker_vision
+
+    if worker_vision is None:
+        import config
+        worker_vision = Vision(config)
+
+    # The stage timings are handed back to the process which submitted the cover
+    worker_vision.timings = Timings()
+    with worker_vision.timings.span('cover'):
+        worker_vision.write_cover_image(image, cover_filename, calibration_markers)
+
+    return worker_vision.timings.spans
 
 def main():
 
@@ -213,9 +440,11 @@ def main():
             time.sleep(config.camera_calibration_delay)
             continue
 
-        (calibration_markers,frame) = vision.detect_markers(image_filename)
+        (markers,frame) = vision.detect_markers(image_filename)
         os.unlink(image_filename)
 
+        calibration_markers = marker_positions(markers) if markers else None
+
         log.debug("Markers detected during calibration: '{}'".format(calibration_markers))
 
         if calibration_markers and 'disk_center' in calibration_markers and 'disk_edge' in calibration_markers:
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+#
+# Summarizes the rips into the data file plotted by summary-plot.gnuplot:
+#
+#   summarize-rip.py -o summary.dat /mnt/storage/*
+#
+# Only the capture directories with a new or changed 'log.txt' are parsed, the others are
+# known from the state file kept next to the summary. New rips are appended to the summary,
+# it is only rewritten when a rip already in it has changed (for example when it was still
+# ongoing during the previous run). This way the summary can be kept up to date during a
+# production run.
+#
+
+import argparse
+import datetime
+import json
+import os
+import sys
+
+summary_header = "#ID\tstatus\tdisk_type\tsize\tstart\tend\telapsed"
+
+# The timestamps in the logs are in the 'journalctl -o short-iso' format
+timestamp_format = "%Y-%m-%dT%H:%M:%S%z"
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+def summarize(directory, log_file):
+    capture_id = os.path.basename(os.path.normpath(directory))
+
+    with open(log_file, 'r', errors='replace') as f:
+        lines = f.read().splitlines()
+
+    status = 'unknown'
+    for line in lines:
+        if ':__main__:' not in line and ':pipeline:' not in line:
+            continue
+        if 'Disc successfuly imaged' in line:
+            status = 'done'
+        elif 'Disk could not be imaged' in line and status != 'done':
+            status = 'fail'
+
+    begin_ts = lines[1].split()[0] if len(lines) > 1 and lines[1].split() else ''
+    end_ts = lines[-1].split()[0] if lines and lines[-1].split() else ''
+
+    elapsed = ''
+    try:
+        elapsed = int((datetime.datetime.strptime(end_ts, timestamp_format) -
+                       datetime.datetime.strptime(begin_ts, timestamp_format)).total_seconds())
+    except ValueError:
+        log("Rip {} has no valid timestamps in '{}'".format(capture_id, log_file))
+
+    # The compressed images and the ones referenced from the blob store only have
+    # their size in the metadata
+    size = ''
+    try:
+        with open(os.path.join(directory, 'metadata-v1.json'), 'r') as f:
+            size = json.load(f)['image']['size']
+    except (OSError, ValueError, KeyError, TypeError):
+        try:
+            size = os.stat(os.path.join(directory, 'contents', 'data.bin')).st_size
+        except OSError:
+            pass
+
+    try:
+        with open(os.path.join(directory, 'disk-type.txt'), 'r') as f:
+            disk_type = f.read().strip()
+    except OSError:
+        disk_type = ''
+
+    log("Rip {} disktype='{}' begin='{}' end='{}' elapsed='{}' seconds datasize='{}' bytes".format(capture_id, disk_type, begin_ts, end_ts, elapsed, size))
+    return (capture_id, "\t".join(str(value) for value in (capture_id, status, disk_type, size, begin_ts, end_ts, elapsed)))
+
+def load_state(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return { 'rips': dict(), 'order': [] }
+
+def save_state(filename, state):
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_filename, filename)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the rips incrementally")
+    parser.add_argument("-o", "--output", default="summary.dat", help="Summary data file")
+    parser.add_argument("--state", help="State file, '<output>.state' by default")
+    parser.add_argument("--full", action='store_true', help="Parse all of the rips again")
+    parser.add_argument("dirs", nargs='*', help="Capture directories")
+
+    args = parser.parse_args()
+
+    state_filename = args.state or args.output + ".state"
+    state = load_state(state_filename)
+    if args.full or not os.path.exists(args.output):
+        state = { 'rips': dict(), 'order': [] }
+
+    rips = state['rips']
+    appended = []
+    changed = args.full
+
+    for directory in args.dirs:
+        log_file = os.path.join(directory, 'log.txt')
+        try:
+            st = os.stat(log_file)
+        except OSError:
+            log("Rip {} is still ongoing, skipping directory".format(os.path.basename(os.path.normpath(directory))))
+            continue
+
+        # The log file is only parsed again when it has changed since the previous run
+        key = os.path.realpath(directory)
+        watermark = [ st.st_mtime_ns, st.st_size ]
+        if key in rips and rips[key]['watermark'] == watermark:
+            continue
+
+        log("Summarizing rip to dir '{}'".format(directory))
+        (capture_id, row) = summarize(directory, log_file)
+
+        if key in rips:
+            changed = changed or rips[key]['row'] != row
+        else:
+            state['order'].append(key)
+            appended.append(row)
+        rips[key] = { 'watermark': watermark, 'row': row }
+
+    if changed:
+        with open(args.output + ".tmp", 'w') as f:
+            f.write(summary_header + "\n")
+            for key in state['order']:
+                f.write(rips[key]['row'] + "\n")
+        os.rename(args.output + ".tmp", args.output)
+    elif appended or not os.path.exists(args.output):
+        with open(args.output, 'a') as f:
+            if f.tell() == 0:
+                f.write(summary_header + "\n")
+            for row in appended:
+                f.write(row + "\n")
+
+    save_state(state_filename, state)
+
+if __name__ == "__main__":
+    main()